@@ -32,6 +32,9 @@ def parser_factory(styler):
     escape_seqs = s_quo | s_sol | s_rsol | s_back | s_form | s_nl | s_ret | s_tab | s_unicode
     chars = styler('class:string', normal_chars) | styler('class:escape', escape_seqs)
 
+    # Unlike in the repr() example, a string being typed is not styled until it
+    # is closed: the REPL validates with the highlighter's own parse, which
+    # must reject it.
     skip_white = pp.Optional(pp.Suppress(pp.White()))
     string = skip_white + DQUO - pp.Combine(pp.ZeroOrMore(chars)) + DQUO
     string.leaveWhitespace()
@@ -69,7 +72,7 @@ def main():
         ('number', '#b27a01'),
         ('string', '#528f50'),
     ])
-    repl(parser_factory, style=style)
+    repl(parser_factory, style=style, shares_parser=True)
 
 
 if __name__ == '__main__':
@@ -14,16 +14,25 @@ from pp_highlighting import dummy_styler, PPHighlighter, PPValidator
 def repl(parser_factory, *, prompt='> ', multiline=False, style=None,
          validate_while_typing=True, validate=True, prompt_continuation=': ',
          uses_pygments_tokens=False, prints_result=True,
-         prints_exceptions=True):
-    """A read-eval-print loop for pyparsing-highlighting examples."""
+         prints_exceptions=True, shares_parser=False):
+    """A read-eval-print loop for pyparsing-highlighting examples.
+
+    If `shares_parser` is true, the highlighter's parser is also used to parse
+    and validate input, rather than one built by passing the parser factory
+    :data:`dummy_styler`, and the validator reuses the highlighter's parse of
+    each document. Parse error messages may then show alternatives nested
+    where styled parse expressions separate them (see :class:`PPHighlighter`).
+    """
 
     def prompt_continuation_fn(*args, **kwargs):
         return prompt_continuation
 
-    parser = parser_factory(dummy_styler)
     pph = PPHighlighter(parser_factory,
                         uses_pygments_tokens=uses_pygments_tokens)
-    ppv = PPValidator(parser, multiline=multiline) if validate else None
+    parser = pph.expr if shares_parser else parser_factory(dummy_styler)
+    ppv = None
+    if validate:
+        ppv = PPValidator(pph if shares_parser else parser, multiline=multiline)
     history = InMemoryHistory()
 
     session = PromptSession(prompt, multiline=multiline, lexer=pph,
@@ -10,6 +10,15 @@ from .repl import repl
 # pylint: disable=too-many-locals
 def parser_factory(styler):
     """Builds the repr() parser."""
+    def closing(quote):
+        # While highlighting, a string being typed may run to the end of the
+        # input, so that it is styled before it is closed
+        if not styler:
+            return quote
+        unclosed = pp.StringEnd().addCondition(lambda: styler.capturing,
+                                               callDuringTry=True)
+        return quote | unclosed
+
     squo = styler('class:string', "'")
     dquo = styler('class:string', '"')
 
@@ -25,8 +34,8 @@ def parser_factory(styler):
 
     skip_white = pp.Optional(pp.White())
     bytes_prefix = pp.Optional(styler('class:string_prefix', 'b'))
-    string_squo = skip_white + bytes_prefix + squo - pp.ZeroOrMore(chars_squo) + squo
-    string_dquo = skip_white + bytes_prefix + dquo - pp.ZeroOrMore(chars_dquo) + dquo
+    string_squo = skip_white + bytes_prefix + squo - pp.ZeroOrMore(chars_squo) + closing(squo)
+    string_dquo = skip_white + bytes_prefix + dquo - pp.ZeroOrMore(chars_dquo) + closing(dquo)
     string = string_squo | string_dquo
     string.leaveWhitespace()
 
@@ -59,7 +68,7 @@ def main():
         ('string_prefix', '#528f50 bold'),
     ])
     repl(parser_factory, style=style, validate=False, prints_result=False,
-         prints_exceptions=False)
+         prints_exceptions=False, shares_parser=True)
 
 
 if __name__ == '__main__':
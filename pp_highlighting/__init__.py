@@ -1,14 +1,32 @@
 """Syntax highlighting for prompt_toolkit and HTML with pyparsing."""
 
-from .pp_highlighter import DummyStyler, PPHighlighter, Styler
-from .pp_validator import PPValidator
+import sys
+import types
+
+from .ansi import AnsiWriter
+from .pp_highlighter import DummyStyler, PPHighlighter, ProfileEntry, Spans, Styler
+from .telemetry import Aggregator, CallStats
 
 dummy_styler = DummyStyler()
 """DummyStyler: An importable instance of :class:`DummyStyler` to pass to parser
 factories.
 """
 
-__all__ = ['dummy_styler', 'DummyStyler', 'PPHighlighter', 'PPValidator',
-           'Styler']
+__all__ = ['Aggregator', 'AnsiWriter', 'CallStats', 'dummy_styler', 'DummyStyler',
+           'PPHighlighter', 'PPValidator', 'ProfileEntry', 'Spans', 'Styler']
 
 __version__ = '0.2.8'
+
+
+class _Package(types.ModuleType):
+    """Imports :class:`PPValidator`, which subclasses a prompt_toolkit class,
+    the first time it is accessed."""
+
+    def __getattr__(self, name):
+        if name == 'PPValidator':
+            from .pp_validator import PPValidator
+            return PPValidator
+        raise AttributeError('module {!r} has no attribute {!r}'.format(self.__name__, name))
+
+
+sys.modules[__name__].__class__ = _Package
@@ -0,0 +1,129 @@
+"""Writes prompt_toolkit formatted text to text streams as ANSI escape
+sequences, without going through :func:`prompt_toolkit.print_formatted_text`."""
+
+from functools import lru_cache
+import sys
+
+__all__ = ['AnsiWriter']
+
+_RESET = '\x1b[0m'
+
+
+class _CodeTable:
+    """Maps style strings to the escape sequences which set their attributes,
+    computing each one only once."""
+
+    def __init__(self, style, color_depth, include_default_pygments_style):
+        from prompt_toolkit.output.vt100 import _EscapeCodeCache
+        from prompt_toolkit.styles import (default_pygments_style,
+                                           default_ui_style, merge_styles)
+        styles = [default_ui_style()]
+        if include_default_pygments_style:
+            styles.append(default_pygments_style())
+        if style is not None:
+            styles.append(style)
+        self.style = merge_styles(styles)
+        self.codes = {}
+        self._escape_codes = _EscapeCodeCache(color_depth)
+        self._hash = self.style.invalidation_hash()
+
+    def check(self):
+        """Forgets the computed escape sequences if the style has changed."""
+        style_hash = self.style.invalidation_hash()
+        if style_hash != self._hash:
+            self.codes.clear()
+            self._hash = style_hash
+
+    def get(self, style_str):
+        """Returns the escape sequence for a style string."""
+        attrs = self.style.get_attrs_for_style_str(style_str)
+        code = self.codes[style_str] = self._escape_codes[attrs]
+        return code
+
+
+@lru_cache(maxsize=32)
+def _code_table(style, color_depth, include_default_pygments_style):
+    """Returns the shared code table for a style and color depth."""
+    return _CodeTable(style, color_depth, include_default_pygments_style)
+
+
+class AnsiWriter:
+    """Writes prompt_toolkit formatted text, such as the output of
+    :meth:`PPHighlighter.highlight`, to a text stream as text with ANSI escape
+    sequences.
+
+    Each style string is resolved to an escape sequence once and the result
+    is shared between writers with the same style and color depth, and
+    escape sequences are only written when the attributes change, so this is
+    much faster than :func:`prompt_toolkit.print_formatted_text` for large
+    amounts of output. Unlike it, the stream is written to as is, whether or
+    not it is a terminal, and newlines are not translated.
+
+    The attributes are reset when the writer is closed or used as a context
+    manager and exited.
+    """
+
+    def __init__(self, file=None, *, style=None, color_depth=None,
+                 include_default_pygments_style=True):
+        """Creates a new AnsiWriter.
+
+        Args:
+            file: The text stream to write to. The default is `sys.stdout`.
+            style (prompt_toolkit.styles.BaseStyle): The style to use.
+            color_depth (prompt_toolkit.output.ColorDepth): The color depth to
+                use. The default is 256 colors.
+            include_default_pygments_style (bool): Whether to include the
+                default Pygments style, as
+                :func:`prompt_toolkit.print_formatted_text` does.
+        """
+        from prompt_toolkit.output import ColorDepth
+        self.file = sys.stdout if file is None else file
+        self.color_depth = color_depth or ColorDepth.DEFAULT
+        self._table = _code_table(style, self.color_depth,
+                                  include_default_pygments_style)
+        self._last = _RESET
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, fragments):
+        """Writes formatted text to the stream.
+
+        Args:
+            fragments (List[Tuple[str, str]]): The prompt_toolkit text
+                fragments to write.
+        """
+        table = self._table
+        table.check()
+        codes = table.codes
+        last = self._last
+        parts = []
+        for style_str, text, *_ in fragments:
+            code = codes.get(style_str)
+            if code is None:
+                code = table.get(style_str)
+            if code != last:
+                parts.append(code)
+                last = code
+            parts.append(text)
+        self._last = last
+        self.file.write(''.join(parts))
+
+    def reset(self):
+        """Resets the attributes, if they have been set."""
+        if self._last != _RESET:
+            self.file.write(_RESET)
+            self._last = _RESET
+
+    def flush(self):
+        """Flushes the stream."""
+        self.file.flush()
+
+    def close(self):
+        """Resets the attributes and flushes the stream. The stream is not
+        closed."""
+        self.reset()
+        self.flush()
@@ -0,0 +1,224 @@
+"""Finds the characters a pyparsing parse expression can start matching with."""
+
+import re
+
+import pyparsing as pp
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    import sre_constants  # pylint: disable=deprecated-module
+    import sre_parse  # pylint: disable=deprecated-module
+
+__all__ = ['first_chars_re']
+
+# Non-ASCII characters which str.upper() maps to ASCII letters, for caseless
+# literals and keywords.
+_UPPER_EXTRAS = {'I': 'ı', 'S': 'ſ'}
+
+_CATEGORIES = {
+    sre_constants.CATEGORY_DIGIT: r'\d',
+    sre_constants.CATEGORY_NOT_DIGIT: r'\D',
+    sre_constants.CATEGORY_SPACE: r'\s',
+    sre_constants.CATEGORY_NOT_SPACE: r'\S',
+    sre_constants.CATEGORY_WORD: r'\w',
+    sre_constants.CATEGORY_NOT_WORD: r'\W',
+}
+
+_REPEATS = {sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT}
+if hasattr(sre_constants, 'POSSESSIVE_REPEAT'):
+    _REPEATS.add(sre_constants.POSSESSIVE_REPEAT)
+
+
+class _Any(Exception):
+    """Raised when a parse expression may start with any character."""
+
+
+def _escape(char):
+    """Escapes a character for use in a regular expression character set."""
+    return re.escape(char)
+
+
+class _FirstSet:
+    """A set of characters, given as single characters and as regular
+    expression character sets, along with whether the empty string is
+    included."""
+
+    def __init__(self, chars=(), atoms=(), nullable=False):
+        self.chars = set(chars)
+        self.atoms = set(atoms)
+        self.nullable = nullable
+
+    def update(self, other):
+        """Adds the characters of another set to this one."""
+        self.chars |= other.chars
+        self.atoms |= other.atoms
+
+    def add_whitespace(self, expr):
+        """Adds the whitespace characters an expression skips, since it may be
+        preceded by them."""
+        if expr.skipWhitespace:
+            self.chars.update(expr.whiteChars)
+
+
+def _caseless(char):
+    """Returns the characters which upper-case to the same character."""
+    upper = char.upper()
+    if char.lower() == upper:
+        return {char}
+    if not (upper.isalpha() and ord(upper) < 128):
+        raise _Any
+    return {upper, upper.lower()} | set(_UPPER_EXTRAS.get(upper, ''))
+
+
+def _first_regex(items, flags):
+    """Finds the first characters of a parsed regular expression."""
+    result = _FirstSet(nullable=True)
+    for op, av in items:
+        item = _FirstSet()
+        if op == sre_constants.LITERAL:
+            item.chars.add(chr(av))
+        elif op == sre_constants.NOT_LITERAL:
+            item.atoms.add('[^{}]'.format(_escape(chr(av))))
+        elif op == sre_constants.ANY:
+            if flags & re.DOTALL:
+                raise _Any
+            item.atoms.add(r'[^\n]')
+        elif op == sre_constants.IN:
+            parts = []
+            for in_op, in_av in av:
+                if in_op == sre_constants.NEGATE:
+                    parts.insert(0, '^')
+                elif in_op == sre_constants.LITERAL:
+                    parts.append(_escape(chr(in_av)))
+                elif in_op == sre_constants.RANGE:
+                    parts.append('{}-{}'.format(*map(_escape, map(chr, in_av))))
+                elif in_op == sre_constants.CATEGORY and in_av in _CATEGORIES:
+                    parts.append(_CATEGORIES[in_av])
+                else:
+                    raise _Any
+            item.atoms.add('[{}]'.format(''.join(parts)))
+        elif op in _REPEATS:
+            item = _first_regex(av[2], flags)
+            item.nullable = item.nullable or av[0] == 0
+        elif op == sre_constants.SUBPATTERN:
+            if len(av) == 4 and av[1] & re.IGNORECASE:
+                raise _Any
+            item = _first_regex(av[-1], flags)
+        elif op == sre_constants.BRANCH:
+            item.nullable = False
+            for branch in av[1]:
+                sub = _first_regex(branch, flags)
+                item.update(sub)
+                item.nullable = item.nullable or sub.nullable
+        elif op in {sre_constants.AT, sre_constants.ASSERT,
+                    sre_constants.ASSERT_NOT}:
+            item.nullable = True
+        else:
+            raise _Any
+        result.update(item)
+        if not item.nullable:
+            result.nullable = False
+            break
+    return result
+
+
+def _first(expr, memo):
+    """Finds the first characters of a parse expression."""
+    # pylint: disable=too-many-branches
+    from .pp_highlighter import StyledElement  # pylint: disable=cyclic-import
+    key = id(expr)
+    if key in memo:
+        if memo[key] is None:
+            # A recursive reference in first position; give up.
+            raise _Any
+        return memo[key]
+    memo[key] = None
+
+    result = _FirstSet()
+    if isinstance(expr, pp.Keyword):
+        if expr.caseless:
+            result.chars |= _caseless(expr.match[0])
+        else:
+            result.chars.add(expr.match[0])
+    elif isinstance(expr, pp.CaselessLiteral):
+        result.chars |= _caseless(expr.match[0])
+    elif isinstance(expr, pp.Literal):
+        if not expr.match:
+            raise _Any
+        result.chars.add(expr.match[0])
+    elif isinstance(expr, pp.Word):
+        result.chars |= set(expr.initChars)
+    elif isinstance(expr, pp.CharsNotIn):
+        result.atoms.add('[^{}]'.format(''.join(map(_escape, expr.notChars))))
+    elif isinstance(expr, pp.White):
+        result.chars |= set(expr.matchWhite)
+    elif isinstance(expr, pp.QuotedString):
+        result.chars.add(expr.quoteChar[0])
+    elif isinstance(expr, pp.Regex):
+        if expr.re.flags & re.IGNORECASE:
+            raise _Any
+        result = _first_regex(sre_parse.parse(expr.re.pattern, expr.re.flags),
+                              expr.re.flags)
+    elif isinstance(expr, pp.And):
+        result.nullable = True
+        for e in expr.exprs:
+            sub = _first(e, memo)
+            result.update(sub)
+            if not sub.nullable:
+                result.nullable = False
+                break
+    elif isinstance(expr, (pp.MatchFirst, pp.Or, pp.Each)):
+        for e in expr.exprs:
+            sub = _first(e, memo)
+            result.update(sub)
+            result.nullable = result.nullable or sub.nullable
+        if isinstance(expr, pp.Each):
+            result.nullable = all(_first(e, memo).nullable for e in expr.exprs)
+    elif isinstance(expr, (pp.Optional, pp.ZeroOrMore, pp.FollowedBy)):
+        result.update(_first(expr.expr, memo))
+        result.nullable = True
+    elif isinstance(expr, (pp.OneOrMore, pp.Forward, pp.TokenConverter,
+                           StyledElement)):
+        if expr.expr is None:
+            raise _Any
+        sub = _first(expr.expr, memo)
+        result.update(sub)
+        result.nullable = sub.nullable
+    else:
+        raise _Any
+
+    result.add_whitespace(expr)
+    memo[key] = result
+    return result
+
+
+def first_chars_re(expr):
+    """Returns a compiled regular expression matching the characters a parse
+    expression can start matching with, after it skips whitespace, or `None`
+    if it could start with any character or match the empty string.
+
+    The result is conservative: it may match characters with which the parse
+    expression cannot actually start matching, but it will always match those
+    with which it can.
+
+    Args:
+        expr (pyparsing.ParserElement): The parse expression.
+
+    Returns:
+        Optional[re.Pattern]: The compiled regular expression.
+    """
+    if expr.ignoreExprs:
+        return None
+    try:
+        result = _first(expr, {})
+    except (_Any, RecursionError):
+        return None
+    if result.nullable:
+        return None
+    if expr.skipWhitespace:
+        result.chars -= set(expr.whiteChars)
+    parts = sorted(result.atoms)
+    if result.chars:
+        parts.insert(0, '[{}]'.format(''.join(map(_escape, sorted(result.chars)))))
+    return re.compile('|'.join(parts) or '(?!)')
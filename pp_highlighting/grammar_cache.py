@@ -0,0 +1,281 @@
+"""Caches built grammars on disk, so that later processes can load them instead
+of calling their parser factories again.
+
+Grammars are pickled. Functions which pickle cannot refer to by name, such as
+lambdas, closures, and the wrappers pyparsing puts around parse actions, are
+pickled along with their compiled code, which is why cache entries are specific
+to the Python implementation and version. Only load caches from trusted
+directories.
+"""
+
+import builtins
+import functools
+import gc
+import hashlib
+import importlib
+import inspect
+import io
+import marshal
+import os
+import pickle
+import sys
+import tempfile
+import types
+import warnings
+
+import pyparsing as pp
+
+__all__ = ['fingerprint', 'load', 'save']
+
+# The modules whose definitions the cached objects depend on
+_OWN_MODULES = ['pp_highlighter.py']
+
+
+def _make_cell(value):
+    """Returns a closure cell containing a value."""
+    return (lambda: value).__closure__[0]
+
+
+def _make_function(code, module, name, qualname, defaults, kwdefaults,
+                   closure, attrs):
+    """Rebuilds a function pickled by :class:`_Pickler`."""
+    if module is None:
+        globals_ = {'__builtins__': builtins}
+    else:
+        globals_ = importlib.import_module(module).__dict__
+    if closure is not None:
+        closure = tuple(map(_make_cell, closure))
+    func = types.FunctionType(marshal.loads(code), globals_, name, defaults,
+                              closure)
+    func.__qualname__ = qualname
+    func.__kwdefaults__ = kwdefaults
+    func.__dict__.update(attrs)
+    return func
+
+
+def _make_class(name, bases, module, qualname):
+    """Recreates a class pickled by :class:`_Pickler`, without its attributes,
+    which are set afterward."""
+    cls = type(name, bases, {'__module__': module})
+    cls.__qualname__ = qualname
+    return cls
+
+
+def _lookup(module, *path):
+    """Returns the object found by following a path of attributes from a
+    module."""
+    obj = importlib.import_module(module)
+    for name in path:
+        obj = getattr(obj, name)
+    return obj
+
+
+def _sentinels():
+    """Returns the objects pyparsing compares parse expressions' attributes
+    with by identity, such as the default value of :class:`pyparsing.Optional`,
+    by id, with the paths to look them up by with :func:`_lookup`."""
+    module = sys.modules[pp.Optional.__module__]
+    owners = [((), module)]
+    owners += [((name,), obj) for name, obj in vars(module).items()
+               if isinstance(obj, type) and obj.__module__ == module.__name__]
+    sentinels = {}
+    for path, owner in owners:
+        for name, obj in vars(owner).items():
+            if (type(obj).__module__ == module.__name__
+                    and not isinstance(obj, (type, pp.ParserElement))):
+                sentinels[id(obj)] = (module.__name__,) + path + (name,)
+    return sentinels
+
+
+def _make_token(name):
+    """Returns the Pygments token with the given dotted name."""
+    from pygments.token import string_to_tokentype
+    return string_to_tokentype(name)
+
+
+class _Pickler(pickle._Pickler):  # pylint: disable=protected-access
+    """A pickler which can also pickle functions and classes that cannot be
+    found by name, such as those defined inside functions, by their code and
+    attributes, and pyparsing's sentinel objects and Pygments tokens, by
+    name."""
+
+    dispatch = dict(pickle._Pickler.dispatch)  # pylint: disable=protected-access
+
+    def __init__(self, file):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self._saving = set()
+        self._sentinels = _sentinels()
+        if 'pygments.token' in sys.modules:
+            token_type = type(sys.modules['pygments.token'].Token)
+            self.dispatch = dict(self.dispatch)
+            self.dispatch[token_type] = _Pickler.save_token
+
+    def save(self, obj, save_persistent_id=True):
+        if id(obj) not in self.memo:
+            path = self._sentinels.get(id(obj))
+            if path is not None:
+                self.save_reduce(_lookup, path, obj=obj)
+                return
+            if isinstance(obj, pp.ParserElement):
+                self.save_element(obj)
+                return
+        super().save(obj, save_persistent_id)
+
+    def save_element(self, obj):
+        """Pickles a parse expression without its cached string
+        representation, which is large and recomputed when needed."""
+        func, args, state, *rest = obj.__reduce_ex__(self.proto)
+        if isinstance(state, dict) and state.get('strRepr') is not None:
+            state = dict(state, strRepr=None)
+        self.save_reduce(func, args, state, *rest, obj=obj)
+
+    def save_function(self, obj):
+        """Pickles a function by name if possible, else by its code."""
+        try:
+            return self.save_global(obj)
+        except pickle.PicklingError:
+            pass
+        if id(obj) in self._saving:
+            raise pickle.PicklingError('Cannot pickle recursive closure {!r}'.format(obj))
+        self._saving.add(id(obj))
+        try:
+            closure = None
+            if obj.__closure__ is not None:
+                closure = tuple(cell.cell_contents for cell in obj.__closure__)
+            args = (marshal.dumps(obj.__code__), obj.__module__, obj.__name__,
+                    obj.__qualname__, obj.__defaults__, obj.__kwdefaults__,
+                    closure, obj.__dict__)
+            self.save_reduce(_make_function, args, obj=obj)
+        finally:
+            self._saving.discard(id(obj))
+
+    dispatch[types.FunctionType] = save_function
+
+    def save_class(self, obj):
+        """Pickles a class by name if possible, else by its attributes."""
+        try:
+            return self.save_global(obj)
+        except pickle.PicklingError:
+            pass
+        if type(obj) is not type:  # pylint: disable=unidiomatic-typecheck
+            raise pickle.PicklingError('Cannot pickle class {!r} with a metaclass'.format(obj))
+        attrs = {name: value for name, value in vars(obj).items()
+                 if name not in ('__dict__', '__weakref__', '__module__',
+                                 '__qualname__')}
+        args = (obj.__name__, obj.__bases__, obj.__module__, obj.__qualname__)
+        # The attributes are set after the class is memoized, since methods
+        # may refer to it
+        self.save_reduce(_make_class, args, (None, attrs), obj=obj)
+
+    dispatch[type] = save_class
+
+    def save_token(self, obj):
+        """Pickles a Pygments token by name."""
+        self.save_reduce(_make_token, ('.'.join(('Token',) + obj),), obj=obj)
+
+
+def fingerprint(parser_factory):
+    """Returns a string identifying a parser factory and the versions of the
+    software the grammar it builds depends on, for use as a cache key.
+
+    The source of the module defining the factory is included, but not that of
+    any modules it imports grammar elements from.
+
+    Args:
+        parser_factory (Callable[[Styler], pyparsing.ParserElement]): The
+            parser factory.
+
+    Returns:
+        str: The fingerprint, as a hex digest.
+
+    Raises:
+        OSError: If the source of the factory's module is not available.
+        TypeError: If the factory is not defined in a module with source.
+    """
+    func, args = parser_factory, []
+    while isinstance(func, functools.partial):
+        args.append((func.args, sorted(func.keywords.items())))
+        func = func.func
+    module = inspect.getmodule(func) or inspect.getmodule(type(func))
+    if module is None:
+        raise TypeError('Cannot find the module of {!r}'.format(parser_factory))
+    qualname = getattr(func, '__qualname__', type(func).__qualname__)
+    parts = [sys.implementation.cache_tag, pp.__version__, module.__name__,
+             qualname, repr(args), inspect.getsource(module)]
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in _OWN_MODULES:
+        with open(os.path.join(here, name), encoding='utf-8') as f:
+            parts.append(f.read())
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf-8', 'surrogatepass') + b'\0')
+    return digest.hexdigest()
+
+
+def _path(cache_dir, parser_factory):
+    """Returns the path of a parser factory's cache entry."""
+    return os.path.join(cache_dir, fingerprint(parser_factory) + '.pickle')
+
+
+def load(cache_dir, parser_factory):
+    """Loads the cached objects built by a parser factory, if there are any.
+
+    Args:
+        cache_dir (str): The cache directory.
+        parser_factory (Callable[[Styler], pyparsing.ParserElement]): The
+            parser factory.
+
+    Returns:
+        Any: The cached objects, or `None` if they are not in the cache or the
+        cache entry could not be loaded.
+    """
+    try:
+        with open(_path(cache_dir, parser_factory), 'rb') as f:
+            data = f.read()
+        # Loading creates many objects but no garbage, so collecting is wasted
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return pickle.loads(data)
+        finally:
+            if enabled:
+                gc.enable()
+    except FileNotFoundError:
+        return None
+    except Exception as err:  # pylint: disable=broad-except
+        msg = 'Could not load cached grammar: {0.__class__.__name__}: {0}'
+        warnings.warn(msg.format(err), RuntimeWarning)
+        return None
+
+
+def save(cache_dir, parser_factory, obj):
+    """Saves the objects built by a parser factory to the cache. The cache
+    entry is replaced atomically, so concurrent processes may share a cache
+    directory.
+
+    If the objects cannot be pickled, a :class:`RuntimeWarning` is issued and
+    nothing is saved.
+
+    Args:
+        cache_dir (str): The cache directory, which is created if it does not
+            exist.
+        parser_factory (Callable[[Styler], pyparsing.ParserElement]): The
+            parser factory.
+        obj (Any): The objects to save.
+    """
+    try:
+        path = _path(cache_dir, parser_factory)
+        buf = io.BytesIO()
+        _Pickler(buf).dump(obj)
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(buf.getvalue())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except Exception as err:  # pylint: disable=broad-except
+        msg = 'Could not cache grammar: {0.__class__.__name__}: {0}'
+        warnings.warn(msg.format(err), RuntimeWarning)
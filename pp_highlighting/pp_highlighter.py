@@ -1,53 +1,1051 @@
 """Syntax highlighting for prompt_toolkit and HTML with pyparsing."""
 
+from array import array
+from bisect import bisect_left, bisect_right
+import codecs
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+import functools
 import html
 import io
+from itertools import chain
+import mmap
+import os
+import pickle
+import re
 import sys
+import threading
+import time
 import warnings
 
-from prompt_toolkit import print_formatted_text
-from prompt_toolkit.formatted_text import (FormattedText, PygmentsTokens,
-                                           split_lines, to_formatted_text)
-from prompt_toolkit.output.vt100 import Vt100_Output
-from prompt_toolkit.lexers import Lexer
 import pyparsing as pp
 
-try:
-    from pygments.token import STANDARD_TYPES, Token
-    HAS_PYGMENTS = True
-except ImportError:
-    HAS_PYGMENTS = False
+from .ansi import AnsiWriter
+from . import grammar_cache
+from .first_chars import first_chars_re
+from .telemetry import CallStats
 
-__all__ = ['DummyStyler', 'PPHighlighter', 'Styler']
+# prompt_toolkit and Pygments are imported where they are first needed, so that
+# highlighting to HTML does not load them.
 
-Vt100_Output._fds_not_a_terminal.add(None)  # pylint: disable=protected-access
+__all__ = ['DummyStyler', 'PPHighlighter', 'ProfileEntry', 'Spans', 'Styler']
+
+
+@contextmanager
+def _patch_file(file):
+    """Monkey patches a non-tty file object for compatibility with
+    prompt_toolkit for the duration of the context."""
+    orig_fileno = None
+    set_encoding = False
+    if file is not None:
+        try:
+            file.fileno()
+        except io.UnsupportedOperation:
+            orig_fileno = file.fileno
+            file.fileno = lambda: None
+        if not hasattr(file, 'encoding'):
+            file.encoding = ''
+            set_encoding = True
+    try:
+        yield
+    finally:
+        if orig_fileno is not None:
+            file.fileno = orig_fileno
+        if set_encoding:
+            del file.encoding
+
+
+def _read_chunks(path, encoding, errors, chunk_size):
+    """Memory-maps a file and decodes it, yielding `chunk_size` bytes at a
+    time."""
+    decoder = codecs.getincrementaldecoder(encoding)(errors)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                for i in range(0, size, chunk_size):
+                    yield decoder.decode(m[i:i + chunk_size])
+    yield decoder.decode(b'', final=True)
+
+
+def _common_prefix_len(a, b, block=4096):
+    """Returns the length of the longest common prefix of two strings."""
+    n = min(len(a), len(b))
+    i = 0
+    while i + block <= n and a[i:i+block] == b[i:i+block]:
+        i += block
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def _common_suffix_len(a, b, limit, block=4096):
+    """Returns the length of the longest common suffix of two strings, up to
+    `limit` characters."""
+    m, n = len(a), len(b)
+    i = 0
+    while i + block <= limit and a[m-i-block:m-i] == b[n-i-block:n-i]:
+        i += block
+    while i < limit and a[m-i-1] == b[n-i-1]:
+        i += 1
+    return i
+
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+ProfileEntry = namedtuple('ProfileEntry', 'element style attempts successes '
+                          'discarded total_time self_time')
+ProfileEntry.__doc__ = """The profile of one styled parse expression (see
+:meth:`PPHighlighter.profile_report`).
+
+Attributes:
+    element (StyledElement): The styled parse expression.
+    style (Union[pygments.token.Token, str]): Its style.
+    attempts (int): The number of times it was tried while capturing.
+    successes (int): The number of times it matched.
+    discarded (int): The number of text fragments it captured which were
+        discarded by backtracking or :meth:`Styler.delete`.
+    total_time (float): The time in seconds spent matching it, including
+        other styled parse expressions inside it.
+    self_time (float): The time in seconds spent matching it, excluding
+        other styled parse expressions inside it.
+"""
+
+# Highlighters built by worker processes, by pickled constructor arguments
+_worker_highlighters = {}
+
+
+class _Counters(threading.local):
+    """Per-thread statistics on the current call to a :class:`PPHighlighter`
+    method, for its observer (see :class:`CallStats`)."""
+    failures = None
+    fragments = None
+    cache_hit = None
+
+
+def _observed(operation):
+    """Decorates a :class:`PPHighlighter` method which takes a string or
+    document to report each call to the highlighter's observer."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, s, *args, **kwargs):
+            if self.observer is None:
+                return method(self, s, *args, **kwargs)
+            counters = self._counters
+            counters.failures = counters.fragments = counters.cache_hit = None
+            start = time.perf_counter()
+            result = method(self, s, *args, **kwargs)
+            elapsed = time.perf_counter() - start
+            text = s.text if operation == 'lex_document' else s
+            stats = CallStats(operation, len(text), counters.fragments,
+                              counters.failures, elapsed, counters.cache_hit)
+            try:
+                self.observer(stats)
+            except Exception as err:  # pylint: disable=broad-except
+                msg = 'Exception in observer: {0.__class__.__name__}: {0}'
+                warnings.warn(msg.format(err), RuntimeWarning)
+            return result
+        return wrapper
+    return decorator
+
+
+def _check_str(s):
+    """Raises :class:`TypeError` if an object to highlight is not a string."""
+    if not isinstance(s, str):
+        msg = 'Cannot highlight type {}, only str.'
+        raise TypeError(msg.format(type(s).__name__))
+
+
+def _slice_fragments(fragments, start, end):
+    """Returns the part of a list of text fragments which covers their text
+    from `start` up to `end`."""
+    result, loc = [], 0
+    for style, text in fragments:
+        if loc >= end:
+            break
+        piece = text[max(start - loc, 0):end - loc]
+        if piece:
+            result.append((style, piece))
+        loc += len(text)
+    return result
+
+
+def _register_lexer():
+    """Registers :class:`PPHighlighter` as a virtual subclass of
+    :class:`prompt_toolkit.lexers.Lexer`."""
+    from prompt_toolkit.lexers import Lexer
+    Lexer.register(PPHighlighter)
+
+
+def _highlight_chunk(spec, method, kwargs, strings):
+    """Highlights a list of strings in a worker process, building the
+    highlighter from its pickled constructor arguments the first time."""
+    pph = _worker_highlighters.get(spec)
+    if pph is None:
+        parser_factory, options = pickle.loads(spec)
+        pph = PPHighlighter(parser_factory, **options)
+        _worker_highlighters[spec] = pph
+    func = getattr(pph, method)
+    return [func(s, **kwargs) for s in strings]
+
+
+class _LRUCache:
+    """A size-bounded mapping which evicts its least recently used items. It
+    may be used from several threads at once."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """Returns the value for `key` and marks it as most recently used, or
+        returns `None` if there is none."""
+        with self._lock:
+            try:
+                value = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Sets the value for `key`, evicting the least recently used item if
+        the cache is full."""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        """Removes all items and resets the statistics."""
+        with self._lock:
+            self._items.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        """Returns the cache statistics."""
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize,
+                             len(self._items))
+
+
+class _ParseMemo:
+    """A size-bounded memo of the results of styled parse expressions, and of
+    the parse expressions containing them, on one string, which also records
+    the spans captured while computing each result so it can replay them."""
+
+    def __init__(self, maxsize):
+        self.cache = _LRUCache(maxsize)
+        self.string = None
+
+    def parse(self, spans, node, parse, instring, loc, *args):
+        """Parses with a parse expression by calling `parse`, capturing into
+        `spans`, or replays the result of an earlier identical parse."""
+        if instring is not self.string:
+            self.cache.clear()
+            self.string = instring
+        spans.string = instring
+        data = spans.data
+        key = node, loc, args
+        entry = self.cache.get(key)
+        if entry is not None:
+            writes, result = entry
+            data.extend(writes)
+            if isinstance(result, Exception):
+                raise result.with_traceback(None)
+            return result[0], result[1].copy()
+
+        start = len(data)
+        try:
+            end_loc, toks = parse(instring, loc, *args)
+        except pp.ParseBaseException as err:
+            # A new exception keeps the memo from holding on to stack frames
+            self.cache.put(key, (data[start:], err.__class__(*err.args)))
+            raise
+        self.cache.put(key, (data[start:], (end_loc, toks.copy())))
+        return end_loc, toks
+
+
+# The style id of span log entries which mark deletions
+_DELETED = -1
+
+# The fields of the profile of a styled parse expression in one thread
+_ATTEMPTS, _SUCCESSES, _DISCARDED, _TOTAL_TIME, _SELF_TIME, _DEPTH = range(6)
+
+
+class _OutOfTime(Exception):
+    """Raised when highlighting runs past its deadline. It is not a
+    :class:`pyparsing.ParseBaseException`, so parse expressions do not recover
+    from it.
+
+    Attributes:
+        loc (Optional[int]): Where scanning stopped.
+        fragments (Optional[list]): The text fragments highlighted so far,
+            followed by the rest of the string unstyled.
+        state (Optional[tuple]): For incremental highlighting, the results of
+            the scan so far, from which the next scan may resume.
+    """
+
+    def __init__(self, loc=None):
+        super().__init__(loc)
+        self.loc = loc
+        self.fragments = None
+        self.state = None
+
+
+class _SpanLog:
+    """An append-only log of the spans of text captured by styled parse
+    expressions, stored as a flat array of (start, end, style id) triples.
+    Later entries take precedence over earlier ones with the same start
+    location, and entries with a negative style id mark deletions.
+
+    The log is transactional: a parse expression whose failure may be
+    recovered from notes the length of :attr:`data` before it starts, and if
+    it fails, truncates the log back to that length, discarding everything
+    captured in the meantime.
+    """
+
+    def __init__(self):
+        self.data = array('l')
+        self.string = None
+        self.deadline = None
+        # When profiling, the profiles of the styled parse expressions which
+        # captured each span, latest last, by span
+        self.owners = None
+        # The number of entries latest() last saw, and its result
+        self._latest = None
+
+    def __len__(self):
+        return len(self.data) // 3
+
+    def clear(self):
+        """Removes all entries."""
+        del self.data[:]
+        self._latest = None
+        if self.owners is not None:
+            self.owners.clear()
+
+    def truncate(self, length):
+        """Removes the entries past the first `length` values of
+        :attr:`data`."""
+        data = self.data
+        if self.owners:
+            for i in range(length, len(data), 3):
+                self._discard(tuple(data[i:i+3]))
+        if self._latest is not None and self._latest[0] * 3 > length:
+            self._latest = None
+        del data[length:]
+
+    def delete(self, loc):
+        """Marks the span starting at a given location as deleted."""
+        if self.owners:
+            i = self.latest().get(loc)
+            if i is not None and self.data[i*3+2] >= 0:
+                self._discard(tuple(self.data[i*3:i*3+3]))
+        self.data.extend((loc, loc, _DELETED))
+
+    def _discard(self, span):
+        """Counts a span as discarded in the profile of the styled parse
+        expression which captured it last."""
+        owners = self.owners.get(span)
+        if owners:
+            owners.pop()[_DISCARDED] += 1
+
+    def latest(self):
+        """Returns a dict from each start location to the index of the latest
+        entry for it, which must not be modified. It is updated with only the
+        entries added since the last call, unless some were removed."""
+        count, latest = self._latest or (0, {})
+        length = len(self)
+        if count < length:
+            latest.update(zip(self.data[count*3::3], range(count, length)))
+        self._latest = length, latest
+        return latest
+
+    def compact(self, start=0, end=None):
+        """Returns a new log with only the latest entry for each start location
+        from `start` up to `end`, in order, omitting deletions."""
+        data = self.data
+        result = _SpanLog()
+        result.string = self.string
+        latest = self.latest()
+        for loc in sorted(latest):
+            i = latest[loc] * 3
+            if start <= loc and (end is None or loc < end) and data[i+2] >= 0:
+                result.data.extend(data[i:i+3])
+        return result
+
+    def resolve(self, styles, start=0, end=None):
+        """Returns the non-overlapping styled spans from `start` up to `end`,
+        in order, as a :class:`Spans` object.
+
+        Only spans starting before `end` (by default, the end of the string) are
+        included, though the last may extend past it.
+        """
+        string = self.string
+        end = len(string) if end is None else end
+        data = self.data
+        latest = self.latest()
+        result = Spans(string, array('l'), array('l'), array('l'), styles)
+        locs = sorted(latest)
+        loc = start
+        for i in range(bisect_left(locs, start), len(locs)):
+            span_start = locs[i]
+            if span_start >= end:
+                break
+            if span_start < loc:
+                continue
+            j = latest[span_start] * 3
+            span_end, style_id = data[j+1], data[j+2]
+            if span_end > span_start and style_id >= 0:
+                result.starts.append(span_start)
+                result.ends.append(span_end)
+                result.style_ids.append(style_id)
+                loc = span_end
+        return result
+
+
+class Spans:
+    """The styled spans of a highlighted string, stored compactly as parallel
+    arrays of start and end locations and indexes into a table of styles.
+    Text is only copied out of the string when it is converted to fragments.
+
+    Iterating over a :class:`Spans` object yields `(start, end, style)`
+    tuples, in order. The text between spans is unstyled.
+
+    Attributes:
+        string (str): The highlighted string.
+        starts (array.array): The start locations of the spans.
+        ends (array.array): The end locations of the spans.
+        style_ids (array.array): The indexes of the styles of the spans in
+            `styles`.
+        styles (List[Union[pygments.token.Token, str]]): The table of styles.
+        stopped_at (Optional[int]): Where highlighting stopped because its
+            time budget ran out, leaving the rest of the string unstyled, or
+            `None` if the string was highlighted in full.
+    """
+
+    def __init__(self, string, starts, ends, style_ids, styles):
+        self.string = string
+        self.starts = starts
+        self.ends = ends
+        self.style_ids = style_ids
+        self.styles = styles
+        self.stopped_at = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        styles = self.styles
+        for start, end, style_id in zip(self.starts, self.ends, self.style_ids):
+            yield start, end, styles[style_id]
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, list(self))
+
+    def fragments(self, default_style='', start=0, end=None):
+        """Converts the spans and the unstyled text between them to text
+        fragments.
+
+        Args:
+            default_style (Union[pygments.token.Token, str]): The style for
+                unstyled text.
+            start (int): The location to start at.
+            end (Optional[int]): The location to end at, unless the last span
+                extends past it. The default is the end of the string.
+
+        Returns:
+            prompt_toolkit.formatted_text.FormattedText: The text fragments.
+        """
+        from prompt_toolkit.formatted_text import FormattedText
+        return FormattedText(self._fragments(default_style, start, end))
+
+    def _fragments(self, default_style='', start=0, end=None):
+        """Converts the spans and the unstyled text between them to a list of
+        text fragments."""
+        s, styles = self.string, self.styles
+        end = len(s) if end is None else end
+        fragments = []
+        loc = start
+        for span_start, span_end, style_id in zip(self.starts, self.ends,
+                                                  self.style_ids):
+            if span_start > loc:
+                fragments.append((default_style, s[loc:span_start]))
+            fragments.append((styles[style_id], s[span_start:span_end]))
+            loc = span_end
+        if loc < end:
+            fragments.append((default_style, s[loc:end]))
+        return fragments
+
+
+# Parse expressions which recover from the failure of their subexpressions
+_CATCHING = (pp.MatchFirst, pp.Or, pp.Each, pp.Optional, pp.ZeroOrMore,
+             pp.OneOrMore, pp.SkipTo)
+
+# Parse expressions which discard the text their subexpression matched
+_LOOKAROUND = tuple(getattr(pp, name) for name in ['FollowedBy', 'PrecededBy']
+                    if hasattr(pp, name))
+
+# Parse expressions which may examine text past the end of what they match
+_LOOKAHEAD = (pp.FollowedBy, pp.NotAny, pp.Or, pp.Each)
+
+
+def _capturing_method(base, name):
+    """Returns the method of a base class to call while capturing. For
+    `_parse`, it skips pyparsing's packrat cache, whose results would not
+    capture their text again, in favor of the styler's memo, which replays the
+    spans too."""
+    # pylint: disable=protected-access
+    if name != '_parse':
+        return getattr(base, name)
+    if issubclass(base, StyledElement):
+        # Styled parse expressions use the memo themselves
+        return base._parseNoCache
+
+    def parse(self, instring, loc, doActions=True, callPreParse=True):
+        styler = self._rollback_styler
+        memo = styler.memo
+        if memo is None:
+            return base._parseNoCache(self, instring, loc, doActions, callPreParse)
+        return memo.parse(styler.spans, self, functools.partial(base._parseNoCache, self),
+                          instring, loc, doActions, callPreParse)
+    return parse
+
+
+def _uncached(base, name):
+    """Returns a parse method which calls that of a base class, skipping
+    pyparsing's packrat cache while capturing."""
+    parse = _capturing_method(base, name)
+
+    def method(self, *args, **kwargs):
+        if not self._rollback_styler.capturing:
+            return getattr(base, name)(self, *args, **kwargs)
+        return parse(self, *args, **kwargs)
+    return method
+
+
+def _rollback_on_failure(base, name):
+    """Returns a parse method which calls that of a base class and truncates
+    the current thread's span log back to where it was if parsing fails,
+    though not if it runs out of time, since what it captured is the best
+    guess at the partial result."""
+    parse = _capturing_method(base, name)
+
+    def method(self, *args, **kwargs):
+        styler = self._rollback_styler
+        if not styler.capturing:
+            return getattr(base, name)(self, *args, **kwargs)
+        spans = styler.spans
+        mark = len(spans.data)
+        try:
+            return parse(self, *args, **kwargs)
+        except _OutOfTime:
+            raise
+        except Exception:
+            spans.truncate(mark)
+            raise
+    return method
+
+
+def _rollback_always(base, name):
+    """Returns a parse method which calls that of a base class and truncates
+    the current thread's span log back to where it was whether or not parsing
+    succeeds."""
+    parse = _capturing_method(base, name)
+
+    def method(self, *args, **kwargs):
+        styler = self._rollback_styler
+        if not styler.capturing:
+            return getattr(base, name)(self, *args, **kwargs)
+        spans = styler.spans
+        mark = len(spans.data)
+        try:
+            return parse(self, *args, **kwargs)
+        finally:
+            spans.truncate(mark)
+    return method
+
+
+# Subclasses of parse expression classes made by _wrapped_class, by base class
+# and wrappers
+_wrapped_classes = {}
+_wrapped_classes_lock = threading.Lock()
+
+
+def _wrapped_class(cls, **wrappers):
+    """Returns a subclass of a parse expression class whose methods are
+    wrapped, given functions which take the original class and a method name
+    and return the wrapping method, by method name. If `cls` was returned by an
+    earlier call, its wrappers are kept unless replaced.
+
+    The methods are not set on parse expressions themselves, since pyparsing
+    copies their attributes to their copies (e.g. by
+    :meth:`pyparsing.ParserElement.setResultsName`), which would then parse
+    as the originals. Copies keep the class instead."""
+    wrappers = dict(getattr(cls, '_wrappers', {}), **wrappers)
+    base = getattr(cls, '_wrapped_base', cls)
+    key = base, tuple(sorted(wrappers.items(), key=lambda item: item[0]))
+    with _wrapped_classes_lock:
+        sub = _wrapped_classes.get(key)
+        if sub is None:
+            attrs = {name: wrap(base, name) for name, wrap in wrappers.items()}
+            # The name of the class appears in pyparsing's error messages
+            attrs.update(__module__=base.__module__, __qualname__=base.__qualname__,
+                         _wrapped_base=base, _wrappers=wrappers)
+            sub = _wrapped_classes[key] = type(base.__name__, (base,), attrs)
+    return sub
+
+
+def _children(node):
+    """Returns the parse expressions a parse expression is made of."""
+    kids = list(node.ignoreExprs)
+    if isinstance(node, pp.ParseExpression):
+        kids += node.exprs
+    for name in ['expr', 'failOn', 'ignoreExpr']:
+        kid = getattr(node, name, None)
+        if isinstance(kid, pp.ParserElement):
+            kids.append(kid)
+    return kids
+
+
+def _looks_ahead(expr):
+    """Returns whether a grammar contains parse expressions whose matches may
+    depend on text past their end, such as lookaheads and
+    :class:`pyparsing.Or`, which tries every alternative."""
+    seen = set()
+    stack = [expr]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        if isinstance(node, _LOOKAHEAD):
+            return True
+        stack.extend(_children(node))
+    return False
+
+
+def _install_rollback(expr, styler, uncached=False):
+    """Makes the parse expressions in a grammar which contain styled ones roll
+    back the spans they captured when they fail and their failure is
+    recovered from, when they are only tried (as by :class:`pyparsing.Or`),
+    and when they are only looked ahead or behind to. While capturing, they
+    skip pyparsing's packrat cache, which would replay their results without
+    capturing their text again after it was rolled back, in favor of the
+    styler's memo. If `uncached` is false, those which need no rollback are
+    left alone, which is faster if neither cache is in use.
+
+    The wrapped methods are only in place while some thread is capturing (see
+    :meth:`Styler._wrap`), so that otherwise the grammar parses as fast as
+    one which was never wrapped. Copies of its parse expressions made at such
+    times therefore parse without rollback."""
+    # pylint: disable=protected-access
+    if not expr.streamlined:
+        expr.streamline()
+    nodes, children, parents = {}, {}, {}
+    stack = [expr]
+    while stack:
+        node = stack.pop()
+        if id(node) in nodes:
+            continue
+        nodes[id(node)] = node
+        kids = _children(node)
+        children[id(node)] = kids
+        for kid in kids:
+            parents.setdefault(id(kid), []).append(node)
+            stack.append(kid)
+
+    # Find the parse expressions with styled ones below them
+    styled_below = set()
+    stack = [node for node in nodes.values() if isinstance(node, StyledElement)]
+    while stack:
+        for parent in parents.get(id(stack.pop()), []):
+            if id(parent) not in styled_below:
+                styled_below.add(id(parent))
+                stack.append(parent)
+
+    wrappers = {}
+    for node in nodes.values():
+        if id(node) in styled_below or isinstance(node, StyledElement):
+            wrappers.setdefault(id(node), {})['tryParse'] = _rollback_always
+        if id(node) in styled_below and isinstance(node, _LOOKAROUND):
+            wrappers[id(node)]['_parse'] = _rollback_always
+        elif id(node) in styled_below and uncached:
+            wrappers[id(node)].setdefault('_parse', _uncached)
+        catching = set(map(id, node.ignoreExprs))
+        if isinstance(node, _CATCHING):
+            catching.update(map(id, children[id(node)]))
+        for kid_id in catching & styled_below:
+            kid_wrappers = wrappers.setdefault(kid_id, {})
+            if kid_wrappers.get('_parse', _uncached) is _uncached:
+                kid_wrappers['_parse'] = _rollback_on_failure
+    for node_id, node_wrappers in wrappers.items():
+        node = nodes[node_id]
+        _, plain, wrapped = styler._wrapped.get(node_id, (node, type(node), type(node)))
+        if getattr(wrapped, '_wrappers', {}).get('_parse') is _rollback_always:
+            node_wrappers['_parse'] = _rollback_always
+        node._rollback_styler = styler
+        styler._wrap(node, plain, _wrapped_class(wrapped, **node_wrappers))
+
+
+class _ThreadProfile:
+    """The profiles of styled parse expressions recorded by one thread, by id,
+    and the time spent so far in the styled parse expressions inside each one
+    the thread is matching."""
+
+    def __init__(self):
+        self.stats = {}
+        self.stack = []
+
+
+def _profiled(base, name):
+    """Returns a parseImpl method for a styled parse expression which calls
+    that of a base class and records its profile while capturing."""
+    timer = time.perf_counter
+
+    def method(self, instring, loc, doActions=True):
+        # pylint: disable=protected-access
+        parse_impl = getattr(base, name)
+        styler = self.styler
+        if not styler.capturing:
+            return parse_impl(self, instring, loc, doActions)
+        profile = styler._thread_profile()
+        stats = profile.stats.get(id(self))
+        if stats is None:
+            stats = profile.stats[id(self)] = [0, 0, 0, 0.0, 0.0, 0]
+            styler._add_profiled(self)
+        stack = profile.stack
+        stats[_ATTEMPTS] += 1
+        stats[_DEPTH] += 1
+        stack.append(0.0)
+        start = timer()
+        try:
+            end_loc, toks = parse_impl(self, instring, loc, doActions)
+        finally:
+            elapsed = timer() - start
+            stats[_SELF_TIME] += elapsed - stack.pop()
+            stats[_DEPTH] -= 1
+            if not stats[_DEPTH]:
+                # Recursive matches are already included
+                stats[_TOTAL_TIME] += elapsed
+            if stack:
+                stack[-1] += elapsed
+        stats[_SUCCESSES] += 1
+        spans = styler.spans
+        if spans.owners is None:
+            spans.owners = {}
+        spans.owners.setdefault((loc, end_loc, self.style_id), []).append(stats)
+        return end_loc, toks
+    return method
+
+
+def _install_profiling(expr, styler):
+    """Makes the styled parse expressions in a grammar record their profiles
+    in `styler` (see :meth:`Styler.profile`)."""
+    seen = set()
+    stack = [expr]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        if isinstance(node, StyledElement):
+            if 'parseImpl' not in getattr(type(node), '_wrappers', {}):
+                node.__class__ = _wrapped_class(type(node), parseImpl=_profiled)
+            styler._add_profiled(node)  # pylint: disable=protected-access
+        stack.extend(_children(node))
 
 
 class StyledElement(pp.ParserElement):
-    """Saves the original, untokenized text matched by a parse expression as a
-    prompt_toolkit text fragment."""
+    """Records the span of original, untokenized text matched by a parse
+    expression, to be styled as a prompt_toolkit text fragment."""
 
-    def __init__(self, fragments, style, expr):
+    def __init__(self, styler, style, expr):
         super().__init__()
-        self._fragments = fragments
+        self.styler = styler
         self.style = style
+        self.style_id = styler.style_id(style)
         self.expr = expr
 
     def __str__(self):
-        return str(self.expr)
+        # A name given with setName() takes precedence, as for other expressions
+        name = getattr(self, 'name', None)
+        return str(self.expr) if name is None else name
+
+    def streamline(self):
+        # Unlike pyparsing.ParseElementEnhance, ParserElement does not
+        # streamline subexpressions, which would then parse slower than those
+        # of a parser built with a DummyStyler.
+        super().streamline()
+        self.expr.streamline()
+        return self
+
+    def _parse(self, instring, loc, doActions=True, callPreParse=True):
+        # Capturing text is a side effect, so results must not come from
+        # pyparsing's global packrat cache. They may come from the memo instead.
+        # Checking whether any thread is capturing is cheaper than checking
+        # whether this one is, and the check is made for every match attempt.
+        # pylint: disable=protected-access
+        styler = self.styler
+        if (styler._captures or styler.always_capture or self.parseAction
+                or self.resultsName or self.debug or self.failAction):
+            return self._parseNoCache(instring, loc, doActions, callPreParse)
+        # Nothing would be done but parsing the wrapped expression
+        if callPreParse and self.callPreparse:
+            loc = self.preParse(instring, loc)
+        try:
+            return self.expr._parse(instring, loc, doActions, False)
+        except IndexError:
+            raise pp.ParseException(instring, len(instring), self.errmsg, self)
 
     def parseImpl(self, instring, loc, doActions=True):
+        # pylint: disable=protected-access
+        styler = self.styler
+        if not styler.capturing:
+            return self.expr._parse(instring, loc, doActions, False)
+        spans = styler.spans
+        if spans.deadline is not None and time.monotonic() > spans.deadline:
+            raise _OutOfTime()
+        memo = styler.memo
+        if memo is not None:
+            return memo.parse(spans, self, self._capture, instring, loc, doActions)
+        return self._capture(instring, loc, doActions)
+
+    def _capture(self, instring, loc, doActions):
+        """Parses with the wrapped parse expression and captures the span of
+        text it matched."""
         # pylint: disable=protected-access
         end_loc, toks = self.expr._parse(instring, loc, doActions, False)
-        self._fragments[loc] = (self.style, instring[loc:end_loc])
+        spans = self.styler.spans
+        spans.string = instring
+        spans.data.extend((loc, end_loc, self.style_id))
         return end_loc, toks
 
 
 class Styler:
-    """Wraps pyparsing parse expressions to capture styled text fragments."""
+    """Wraps pyparsing parse expressions to capture styled text fragments.
+
+    Each thread captures fragments into its own buffer, so parse expressions
+    wrapped by one :class:`Styler` may be used from several threads at once.
+    The buffer records only the location of each fragment and the index of its
+    style in :attr:`styles`; text is copied out of the input string only when
+    it is asked for.
+
+    A :class:`Styler` constructed with `always_capture=False` only captures
+    fragments inside :meth:`capture`, and otherwise its wrapped parse
+    expressions merely parse, so a single grammar can serve both for
+    highlighting and for plain parsing and validation.
+    """
 
-    def __init__(self):
-        self.fragments = {}
+    def __init__(self, memo_size=0, *, always_capture=True):
+        """Constructs a new :class:`Styler`.
+
+        Args:
+            memo_size (int): The maximum number of results of wrapped parse
+                expressions to memoize while parsing a string, per thread. The
+                default of 0 disables memoization.
+            always_capture (bool): Whether wrapped parse expressions capture
+                text when used outside of :meth:`capture`. If `False`, they
+                cost little more than the parse expressions they wrap there.
+        """
+        self.memo_size = memo_size
+        self.always_capture = always_capture
+        self.styles = []
+        self._style_ids = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiles = {}
+        self._profiled = OrderedDict()
+        # The parse expressions given to _wrap(), by id, with their classes
+        # without and with wrapped methods, and the number of threads capturing
+        self._wrapped = {}
+        self._captures = 0
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for name in ['_lock', '_local', '_profiles', '_profiled', '_wrapped', '_captures']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiles = {}
+        self._profiled = OrderedDict()
+        self._wrapped = {}
+        self._captures = 0
+
+    def _wrap(self, node, plain, wrapped):
+        """Gives a parse expression the class `wrapped` while any thread is
+        capturing and `plain` otherwise, so that its wrapped methods cost
+        nothing when no thread needs them. Other threads then only pass through
+        them."""
+        with self._lock:
+            self._wrapped[id(node)] = node, plain, wrapped
+            node.__class__ = wrapped if self.always_capture or self._captures else plain
+
+    def _count_capture(self, delta):
+        """Counts a thread starting (`delta` 1) or finishing (-1) capturing,
+        switching the classes of the parse expressions given to :meth:`_wrap`
+        when the first starts or the last finishes."""
+        with self._lock:
+            was_capturing = bool(self._captures)
+            self._captures += delta
+            if self.always_capture or was_capturing == bool(self._captures):
+                return
+            i = 2 if self._captures else 1
+            for entry in self._wrapped.values():
+                entry[0].__class__ = entry[i]
+
+    def _thread_profile(self):
+        """Returns the current thread's :class:`_ThreadProfile`."""
+        ident = threading.get_ident()
+        profile = self._profiles.get(ident)
+        if profile is None:
+            with self._lock:
+                profile = self._profiles.setdefault(ident, _ThreadProfile())
+        return profile
+
+    def _add_profiled(self, elem):
+        """Adds a styled parse expression, or a copy of one, to those whose
+        profiles :meth:`profile` returns."""
+        with self._lock:
+            self._profiled.setdefault(id(elem), elem)
+
+    def profile(self):
+        """Returns the profiles of the styled parse expressions made to record
+        them, as by :class:`PPHighlighter` with `profile=True`, combined over
+        all threads. Profiles are only recorded while capturing.
+
+        Returns:
+            List[ProfileEntry]: The profiles.
+        """
+        with self._lock:
+            profiles = list(self._profiles.values())
+            elems = list(self._profiled.values())
+        entries = []
+        for elem in elems:
+            totals = [0, 0, 0, 0.0, 0.0]
+            for profile in profiles:
+                stats = profile.stats.get(id(elem))
+                if stats is not None:
+                    totals = [a + b for a, b in zip(totals, stats)]
+            entries.append(ProfileEntry(elem, elem.style, *totals))
+        return entries
+
+    def profile_clear(self):
+        """Resets the profiles of the styled parse expressions to zero."""
+        with self._lock:
+            for profile in self._profiles.values():
+                for stats in profile.stats.values():
+                    stats[:_DEPTH] = [0, 0, 0, 0.0, 0.0]
+
+    def style_id(self, style):
+        """Returns the index of a style in :attr:`styles`, adding it if it is
+        not already there.
+
+        Args:
+            style (Union[pygments.token.Token, str]): The style.
+
+        Returns:
+            int: The index of the style.
+        """
+        with self._lock:
+            try:
+                return self._style_ids[style]
+            except KeyError:
+                self.styles.append(style)
+                self._style_ids[style] = len(self.styles) - 1
+                return self._style_ids[style]
+
+    @property
+    def capturing(self):
+        """bool: Whether wrapped parse expressions capture styled text in the
+        current thread."""
+        return self.always_capture or getattr(self._local, 'capturing', False)
+
+    @property
+    def spans(self):
+        """The log of spans of styled text captured by the current thread."""
+        try:
+            return self._local.spans
+        except AttributeError:
+            self._local.spans = _SpanLog()
+            return self._local.spans
+
+    @property
+    def fragments(self):
+        """Dict[int, Tuple[Union[pygments.token.Token, str], str]]: A snapshot
+        of the styled text fragments captured by the current thread, by start
+        location."""
+        spans = self.spans
+        data, string = spans.data, spans.string
+        fragments = {}
+        for loc, i in sorted(spans.latest().items()):
+            start, end, style_id = data[i*3:i*3+3]
+            if style_id >= 0:
+                fragments[loc] = self.styles[style_id], string[start:end]
+        return fragments
+
+    @property
+    def memo(self):
+        """The current thread's memo of the results of wrapped parse
+        expressions, or `None` if memoization is disabled."""
+        if self.memo_size <= 0:
+            return None
+        try:
+            return self._local.memo
+        except AttributeError:
+            self._local.memo = _ParseMemo(self.memo_size)
+            return self._local.memo
+
+    @contextmanager
+    def capture(self, spans=None):
+        """Returns a context manager which makes the current thread capture
+        styled text fragments into a new buffer, or into `spans` if given,
+        until it exits. The previous buffer is then restored, so captures may
+        be nested.
+
+        Args:
+            spans (Optional[_SpanLog]): The buffer to capture fragments into,
+                as returned by an earlier call.
+
+        Returns:
+            ContextManager[_SpanLog]: A context manager which returns the
+            buffer.
+        """
+        local = self._local
+        nested = getattr(local, 'capturing', False)
+        saved = dict(local.__dict__)
+        local.spans = _SpanLog() if spans is None else spans
+        if nested and self.memo_size > 0:
+            # The outer capture may be partway through using the memo
+            local.memo = _ParseMemo(self.memo_size)
+        local.capturing = True
+        if not nested:
+            self._count_capture(1)
+        try:
+            yield local.spans
+        finally:
+            if not nested:
+                self._count_capture(-1)
+                if hasattr(local, 'memo'):
+                    saved['memo'] = local.memo
+            local.__dict__.clear()
+            local.__dict__.update(saved)
 
     def __call__(self, style, expr):
         """Wraps the given parse expression to capture the original text it
@@ -68,11 +1066,11 @@ class Styler:
         if isinstance(expr, str):
             # pylint: disable=protected-access
             expr = pp.ParserElement._literalStringClass(expr)
-        return StyledElement(self.fragments, style, expr)
+        return StyledElement(self, style, expr)
 
     def clear(self):
         """Removes all captured styled text fragments."""
-        self.fragments.clear()
+        self.spans.clear()
 
     def delete(self, loc):
         """Removes the styled text fragment starting at a given location if it
@@ -81,7 +1079,7 @@ class Styler:
         Args:
             loc (int): The styled text fragment to delete's start location.
         """
-        self.fragments.pop(loc, None)
+        self.spans.delete(loc)
 
     def get(self, loc):
         """Returns the styled text fragment starting at a given location if it
@@ -94,7 +1092,14 @@ class Styler:
             Optional[Tuple[Union[pygments.token.Token, str], str]]: The styled
             text fragment, if it exists.
         """
-        return self.fragments.get(loc)
+        spans = self.spans
+        i = spans.latest().get(loc)
+        if i is None:
+            return None
+        start, end, style_id = spans.data[i*3:i*3+3]
+        if style_id < 0:
+            return None
+        return self.styles[style_id], spans.string[start:end]
 
     def locs(self):
         """Returns a sorted list of styled text start locations.
@@ -102,7 +1107,8 @@ class Styler:
         Returns:
             List[int]: A sorted list of styled text start locations.
         """
-        return sorted(self.fragments)
+        data = self.spans.data
+        return sorted(loc for loc, i in self.spans.latest().items() if data[i*3+2] >= 0)
 
 
 class DummyStyler(Styler):
@@ -134,7 +1140,7 @@ class DummyStyler(Styler):
         return expr.copy()
 
 
-class PPHighlighter(Lexer):
+class PPHighlighter:
     """Syntax highlighting for prompt_toolkit and HTML with pyparsing.
 
     This class can be used to highlight text via its :meth:`highlight` method
@@ -144,9 +1150,58 @@ class PPHighlighter(Lexer):
     for details), its :meth:`highlight_html` method, its :meth:`print` method,
     and by passing it as the `lexer` argument to a
     :class:`prompt_toolkit.PromptSession`.
+
+    Highlighting is thread-safe, provided the parser's parse actions are, so
+    one :class:`PPHighlighter` may be shared by several threads. (Incremental
+    lexing remembers the last document, so it is meant for use by one
+    :class:`prompt_toolkit.PromptSession` at a time.)
+
+    prompt_toolkit and Pygments are only imported once they are needed, so
+    highlighting to HTML does not load them. :class:`PPHighlighter` is
+    registered as a virtual subclass of :class:`prompt_toolkit.lexers.Lexer` as
+    soon as :mod:`prompt_toolkit.lexers` is imported, whether before or after
+    this module.
+
+    The parser is built once, as :attr:`expr`, and its styled parse
+    expressions capture text only while highlighting, so it may also be used
+    for parsing, e.g. with :meth:`pyparsing.ParserElement.parseString` or
+    :class:`PPValidator`, instead of building a second parser by passing the
+    parser factory a :class:`DummyStyler`. Note that :attr:`expr` does not
+    expand tabs (see :meth:`pyparsing.ParserElement.parseWithTabs`), and that
+    its parse error messages may differ from those of the second parser: each
+    styled parse expression stays a separate level of the grammar, so
+    alternatives on either side of it are not merged, and messages show them
+    nested, e.g. ``Expected {{"nil" | "t"} | number}`` rather than
+    ``Expected {"nil" | "t" | number}``.
+
+    A :class:`PPValidator` constructed with a :class:`PPHighlighter` in place of
+    a parser finds parse errors with :meth:`parse_error`, which shares one scan
+    of each document with :meth:`lex_document`, so a
+    :class:`prompt_toolkit.PromptSession` using both parses each document once.
     """
 
-    def __init__(self, parser_factory, *, uses_pygments_tokens=False):
+    # When lexing lazily, start at least this many lines back from a requested
+    # line, and reuse a line generator if it is at most this many lines back.
+    MIN_LINES_BACKWARDS = 50
+    REUSE_GENERATOR_MAX_DISTANCE = 100
+
+    # Batches with fewer characters than this are highlighted serially, since
+    # starting worker processes would take longer.
+    MIN_PARALLEL_CHARS = 20000
+
+    # When streaming, runs of unstyled text longer than this are output in
+    # pieces rather than held back to be merged.
+    MAX_HELD_CHARS = 2**16
+
+    # The number of documents whose highlighting and parse error are kept for
+    # the lexer and a linked PPValidator, whichever runs second.
+    SHARED_PARSES = 2
+
+    def __init__(self, parser_factory, *, uses_pygments_tokens=False,
+                 incremental=False, lazy=False, syntax_sync=None,
+                 cache_size=0, sync_points=None, memo_size=0,
+                 grammar_cache_dir=None, budget=None, progress_interval=None,
+                 profile=False, observer=None):
         """Constructs a new :class:`PPHighlighter`.
 
         You should supply a parser factory, a function that takes one argument
@@ -172,109 +1227,1094 @@ class PPHighlighter(Lexer):
                 parser factory.
             uses_pygments_tokens (bool): Whether or not the parser is styled
                 using Pygments tokens.
+            incremental (bool): Whether :meth:`lex_document` should remember
+                the previous document and re-highlight only the part of it
+                that may have been affected by an edit. If the parser contains
+                lookaheads (:class:`pyparsing.FollowedBy` or
+                :class:`pyparsing.NotAny`), :class:`pyparsing.Or`, or
+                :class:`pyparsing.Each`, whose matches may depend on text past
+                their end, the text before the edit is re-highlighted too.
+            lazy (bool): Whether :meth:`lex_document` should highlight lines
+                only when they are requested, scanning only as far as needed.
+                Takes precedence over `incremental`.
+            syntax_sync (Optional[prompt_toolkit.lexers.SyntaxSync]): When
+                lexing lazily, finds a position to start highlighting from
+                before a requested line. By default, highlighting starts from
+                the beginning of the document (or from where it left off).
+            cache_size (int): The maximum number of results of
+                :meth:`highlight` and :meth:`highlight_html` to cache, keyed by
+                input string. The default of 0 disables caching.
+            sync_points (Union[str, pyparsing.ParserElement, None]): Where to
+                resume scanning after the parser fails to match: just past the
+                next of the given characters, or the next match of the given
+                parse expression, e.g. ``'\\n'`` or ``';'``. The text in
+                between is left unstyled. By default, the parser is retried at
+                each following location. When re-highlighting incrementally,
+                a failed match is assumed not to depend on the text past the
+                next sync point.
+            memo_size (int): The maximum number of results of styled parse
+                expressions, and of the parse expressions containing them, to
+                memoize while highlighting a string, which helps grammars that
+                often backtrack over the same styled text. As with pyparsing's
+                packrat cache, parse actions are not run again for memoized
+                results. The memo belongs to this highlighter: while
+                highlighting, those parse expressions skip the packrat cache,
+                which is left alone for other parsing. The default of 0
+                disables memoization.
+            grammar_cache_dir (Optional[str]): A directory to cache the parser
+                in, which is then loaded by later highlighters with the same
+                parser factory instead of calling it again. Entries are keyed
+                by a fingerprint of the source of the parser factory's module
+                and the versions of Python and pyparsing (see
+                :mod:`pp_highlighting.grammar_cache`), so the directory should
+                be cleared if a module it imports parse expressions from
+                changes. Only use trusted directories, since the parser is
+                pickled. The default of `None` disables caching.
+            budget (Optional[float]): The time in seconds :meth:`lex_document`
+                may spend highlighting a document, unless lexing lazily. Past
+                it, the rest of the document is styled as the last document
+                highlighted in full was where the text is unchanged, and left
+                unstyled elsewhere, and the document is highlighted in full in
+                a background thread, after which the running prompt_toolkit
+                application is redrawn. When `incremental`, the next scan
+                resumes from where this one stopped. The default of `None` sets
+                no limit.
+            progress_interval (Optional[float]): If given, while a document
+                left partly unstyled for lack of `budget` is highlighted in the
+                background, the application is redrawn this often, in seconds,
+                to show the progress, so the document is styled progressively.
+                Progress is shown between the parser's match attempts, so a
+                grammar which matches the whole document at once shows none.
+                Without `budget`, it has no effect.
+            profile (bool): Whether the styled parse expressions should record
+                how often they match and how long they take while
+                highlighting, for :meth:`profile_report`. Without it, they
+                record nothing and cost nothing extra.
+            observer (Optional[Callable[[CallStats], None]]): Called with the
+                statistics of each call to :meth:`highlight`,
+                :meth:`highlight_html`, and :meth:`lex_document`, e.g. an
+                :class:`Aggregator`.
 
         Raises:
             ImportError: If `uses_pygments_tokens` is `True` and Pygments is
                 not installed.
+            ValueError: If `sync_points` is an empty string.
         """
-        self.styler = Styler()
-        if uses_pygments_tokens and not HAS_PYGMENTS:
-            raise ImportError('Pygments must be installed to use Pygments tokens.')
+        self.parser_factory = parser_factory
+        self.styler = Styler(memo_size, always_capture=False)
+        self._default_style = ''
+        if uses_pygments_tokens:
+            try:
+                from pygments.token import Token
+            except ImportError:
+                raise ImportError('Pygments must be installed to use Pygments tokens.')
+            self._default_style = Token.Text
+        if 'prompt_toolkit.lexers' in sys.modules:
+            _register_lexer()
         self.uses_pygments_tokens = uses_pygments_tokens
-        self.expr = parser_factory(self.styler)
-        self.expr.parseWithTabs()
+        self.incremental = incremental
+        self.lazy = lazy
+        self.syntax_sync = syntax_sync
+        self._lex_state = None
+        self._cache = _LRUCache(cache_size)
+        self._shared = _LRUCache(self.SHARED_PARSES)
+        self._shared_lock = threading.Lock()
+        self.budget = budget
+        self.progress_interval = progress_interval
+        self.observer = observer
+        self._counters = _Counters()
+        self._background = None
+        self._background_lock = threading.Lock()
+        self._scanning = None
+        self._progress = None
+        self._last_lexed = None
+        self._redraws = 0
+        self._html_prefixes = {}
+        self.sync_points = sync_points
+        self._sync_re = None
+        if isinstance(sync_points, str):
+            if not sync_points:
+                raise ValueError('The sync points must not be empty.')
+            self._sync_re = re.compile('[{}]'.format(re.escape(sync_points)))
+        elif sync_points is not None:
+            self._sync_re = first_chars_re(sync_points)
+        self.grammar_cache_dir = grammar_cache_dir
+        loaded = None
+        if grammar_cache_dir is not None:
+            loaded = grammar_cache.load(grammar_cache_dir, parser_factory)
+        if loaded is None:
+            self.expr = parser_factory(self.styler)
+            self.expr.parseWithTabs()
+            self.expr.streamline()
+            if grammar_cache_dir is not None:
+                grammar_cache.save(grammar_cache_dir, parser_factory,
+                                   (self.styler, self.expr))
+        else:
+            self.styler, self.expr = loaded
+            self.styler.memo_size = memo_size
+        self.profile = profile
+        if profile:
+            _install_profiling(self.expr, self.styler)
+        # pylint: disable=protected-access
+        self._uncached = memo_size > 0 or pp.ParserElement._packratEnabled
+        _install_rollback(self.expr, self.styler, self._uncached)
+        self._first_re = first_chars_re(self.expr)
+        self._looks_ahead = _looks_ahead(self.expr)
 
     def __repr__(self):
         return '{0.__class__.__name__}({0.expr!r})'.format(self)
 
-    def _scan_string(self, s):
+    def _scan_string(self, s, loc=0, checkpoints=None, horizons=None,
+                     until=None, first=None, deadline=None):
         """Runs the parser over the input string, capturing styled text.
 
         Adapted from :meth:`pyparsing.ParserElement.scanString` for custom
         exception handling.
+
+        If `checkpoints` is given, the location after each successful match is
+        appended to it, and one past the furthest location the parser may have
+        examined so far is appended to `horizons`. If `until` is given, it is
+        called with each location scanning is about to resume from, and
+        scanning stops at the first one for which it returns true. That
+        location is returned, or `None` if the end of the string was reached.
+        If `first` is given, the outcome of the first match attempt is appended
+        to it: the location the parser matched up to, the exception it raised,
+        or `None` if it could not start matching there. If `deadline` (a
+        :func:`time.monotonic` time) is given and passes, :class:`_OutOfTime`
+        is raised, even partway through a match attempt, in which case the
+        spans it captured so far are kept and its location is where the last
+        of them ends.
+
+        Locations at which the parser cannot start matching, according to
+        :func:`first_chars_re`, are skipped without running the parser. If
+        :attr:`sync_points` is set, scanning resumes at the next sync point
+        after a failed match, which is also recorded as a checkpoint.
+
+        Each failed match attempt is counted for :attr:`observer`.
         """
         if not self.expr.streamlined:
             self.expr.streamline()
         for e in self.expr.ignoreExprs:
             e.streamline()
+        # pylint: disable=protected-access
+        if pp.ParserElement._packratEnabled and not self._uncached:
+            # The packrat cache was enabled after the parser was built
+            self._uncached = True
+            _install_rollback(self.expr, self.styler, True)
 
-        loc = 0
         preloc = None
-        pp.ParserElement.resetCache()
+        horizon = horizons[-1] if horizons else 0
+        first_re = self._first_re
+        spans = self.styler.spans
+        spans.string = s
+        spans.deadline = deadline
+        counters = self._counters
+        counters.failures = counters.failures or 0
         while loc <= len(s):
+            if until is not None and until(loc):
+                return loc
+            if deadline is not None and time.monotonic() > deadline:
+                raise _OutOfTime(loc)
+            nextloc = None
+            started = True
+            mark = len(spans.data)
             try:
                 preloc = self.expr.preParse(s, loc)
-                # pylint: disable=protected-access
-                nextloc, _ = self.expr._parse(s, preloc, callPreParse=False)
+                started = first_re is None or first_re.match(s, preloc)
+                if started:
+                    # pylint: disable=protected-access
+                    nextloc, _ = self.expr._parse(s, preloc, callPreParse=False)
+            except _OutOfTime:
+                raise _OutOfTime(max(spans.data[mark+1::3], default=loc))
             except Exception as err:  # pylint: disable=broad-except
                 if preloc is None:
                     raise
-                self.styler.delete(preloc)
-                loc = preloc + 1
+                if first is not None and not first:
+                    first.append(err)
                 if not isinstance(err, pp.ParseBaseException):
                     msg = 'Exception during parsing: {0.__class__.__name__}: {0}'
                     warnings.warn(msg.format(err), RuntimeWarning)
+            if first is not None and not first:
+                first.append(nextloc if started else None)
+
+            if nextloc is not None and nextloc > loc:
+                loc = nextloc
+                if checkpoints is not None:
+                    # Lookaheads and Or trials may have examined the rest of the
+                    # string, and other matches one character past their end
+                    horizon = max(horizon, float('inf') if self._looks_ahead
+                                  else nextloc + 1)
+                    checkpoints.append(loc)
+                    horizons.append(horizon)
+            elif nextloc is not None:
+                loc = preloc + 1
+            elif self.sync_points is not None:
+                # Skip to the next sync point, assuming the failed attempt did
+                # not look past it
+                counters.failures += 1
+                spans.truncate(mark)
+                loc = self._next_sync(s, preloc)
+                if checkpoints is not None and loc <= len(s):
+                    horizon = max(horizon, loc + 1)
+                    checkpoints.append(loc)
+                    horizons.append(horizon)
+            elif started:
+                counters.failures += 1
+                spans.truncate(mark)
+                loc = preloc + 1
+                if checkpoints is not None:
+                    # Failed attempts may have examined the rest of the string
+                    horizon = float('inf')
             else:
-                loc = nextloc if nextloc > loc else preloc + 1
+                # The parser cannot start matching here, so skip to where it can
+                match = first_re.search(s, preloc + 1)
+                loc = match.start() if match else len(s) + 1
+                if checkpoints is not None:
+                    horizon = max(horizon, loc + 1)
+        return None
+
+    def _next_sync(self, s, loc):
+        """Returns the location just past the first sync point at or after
+        `loc`, or past the end of the string if there is none."""
+        sync_re = self._sync_re
+        while loc < len(s):
+            if sync_re is not None:
+                match = sync_re.search(s, loc)
+                if not match:
+                    break
+                if isinstance(self.sync_points, str):
+                    return match.end()
+                loc = match.start()
+            try:
+                # pylint: disable=protected-access
+                end, _ = self.sync_points._parse(s, loc, False, False)
+            except pp.ParseBaseException:
+                loc += 1
+            else:
+                return max(end, loc + 1)
+        return len(s) + 1
 
-    def _highlight(self, s):
+    def _gather(self, s, loc=0, end=None):
         """Gathers captured styled text and intervening unstyled text into a
-        :class:`prompt_toolkit.formatted_text.FormattedText` instance."""
-        if not isinstance(s, str):
-            msg = 'Cannot highlight type {}, only str.'
-            raise TypeError(msg.format(type(s).__name__))
+        :class:`prompt_toolkit.formatted_text.FormattedText` instance.
+
+        Only text from `loc` up to `end` (by default, the end of the string) is
+        gathered, except that the last styled fragment may extend past `end`.
+        """
+        spans = self._resolve(s, loc, end)
+        return spans._fragments(self._default_style, loc, end)  # pylint: disable=protected-access
+
+    def _resolve(self, s, loc=0, end=None):
+        """Returns the captured styled spans from `loc` up to `end` as a
+        :class:`Spans` object."""
+        spans = self.styler.spans
+        spans.string = s
+        return spans.resolve(self.styler.styles, loc, end)
+
+    def _highlight(self, s, first=None, deadline=None):
+        """Highlights a string from scratch, returning the captured styled text
+        and intervening unstyled text. `first` and `deadline` are passed to
+        :meth:`_scan_string`, and if the deadline passes, the text highlighted
+        so far is attached to the :class:`_OutOfTime` exception."""
+        _check_str(s)
+        with self.styler.capture():
+            try:
+                self._scan_string(s, first=first, deadline=deadline)
+            except _OutOfTime as err:
+                err.fragments = self._gather(s)
+                raise
+            return self._gather(s)
+
+    def _highlight_incremental(self, s, first=None, deadline=None):
+        """Highlights a string, reusing as much as possible of the scan of the
+        string it was last called with.
+
+        The string is compared with the previous one to find the edited region.
+        Scanning resumes from the last checkpoint before the edit that no
+        earlier match attempt looked past, and stops as soon as it reaches a
+        checkpoint after the edit that the previous scan also passed through,
+        from which point on the previous results are shifted into place.
+        `first` is passed to :meth:`_scan_string` if scanning starts from the
+        beginning of the string, and `deadline` is handled as by
+        :meth:`_highlight`, except that the results so far are remembered, so
+        that the next call resumes from them.
+        """
+        _check_str(s)
+        with self.styler.capture():
+            try:
+                self._lex_state = self._scan_incremental(s, self._lex_state, first,
+                                                         deadline)
+            except _OutOfTime as err:
+                self._lex_state = err.state
+                err.fragments = self._gather(s)
+                raise
+            return self._gather(s)
+
+    def _scan_incremental(self, s, state, first=None, deadline=None, until=None):
+        """Runs the parser over the input string for
+        :meth:`_highlight_incremental`, capturing styled text, and returns the
+        results for next time, given those of last time as `state`.
+
+        `until` is called with each location scanning is about to resume from,
+        and may stop it by raising :class:`_OutOfTime`. If scanning stops
+        early, the results so far are attached to the exception as its
+        `state`, which ends at its last checkpoint. A scan resuming from them
+        which resynchronizes with them after the edit carries on from there.
+        """
+        checkpoints, horizons = [0], [0]
+        spans = self.styler.spans
+        try:
+            end = self._scan_from_state(s, state, checkpoints, horizons, first,
+                                        deadline, until)
+            if end is not None and not self._shift_state(s, state, end, checkpoints,
+                                                         horizons):
+                self._scan_string(s, checkpoints[-1], checkpoints, horizons, until,
+                                  None, deadline)
+        except _OutOfTime as err:
+            err.state = s, spans.compact(), checkpoints, horizons, False
+            raise
+        return s, spans.compact(), checkpoints, horizons, True
+
+    def _shift_state(self, s, state, end, checkpoints, horizons):
+        """Appends the previous results after location `end`, where scanning
+        resynchronized with them, shifted into place, to the current ones for
+        :meth:`_scan_incremental`. Returns whether the previous scan was
+        complete; if not, scanning must carry on from the last checkpoint."""
+        old_s, old_spans, old_checkpoints, old_horizons, complete = state
+        delta = len(s) - len(old_s)
+        j = bisect_left(old_checkpoints, end - delta)
+        if checkpoints[-1] == end:
+            j += 1
+        horizon = horizons[-1]
+        for loc, hzn in zip(old_checkpoints[j:], old_horizons[j:]):
+            checkpoints.append(loc + delta)
+            horizons.append(max(horizon, hzn + delta))
+        # An incomplete scan's spans past its last checkpoint are from the match
+        # attempt it stopped in
+        stop = float('inf') if complete else old_checkpoints[-1]
+        spans = self.styler.spans
+        kept = spans.compact(0, end)
+        spans.clear()
+        spans.data.extend(kept.data)
+        old_data = old_spans.data
+        for j in range(0, len(old_data), 3):
+            loc = old_data[j]
+            if end - delta <= loc < stop:
+                spans.data.extend((loc + delta, old_data[j+1] + delta, old_data[j+2]))
+        return complete
+
+    def _scan_from_state(self, s, state, checkpoints, horizons, first, deadline, until):
+        """Scans the input string for :meth:`_scan_incremental`, resuming from
+        the previous results where possible. Returns the location at which
+        scanning resynchronized with them, or `None` if it reached the end of
+        the string."""
+        if state is None:
+            return self._scan_string(s, 0, checkpoints, horizons, until, first,
+                                     deadline)
+        old_s, old_spans, old_checkpoints, old_horizons, _ = state
+        prefix = _common_prefix_len(old_s, s)
+        suffix = _common_suffix_len(old_s, s, min(len(old_s), len(s)) - prefix)
+        delta = len(s) - len(old_s)
+
+        # Find the last checkpoint no earlier match attempt looked past, then
+        # back off one more, since a successful match may have looked ahead
+        # past its end (e.g. for another repetition) without it showing.
+        i = min(bisect_right(old_checkpoints, prefix),
+                bisect_right(old_horizons, prefix)) - 2
+        i = max(i, 0)
+        start = old_checkpoints[i]
+        checkpoints[:], horizons[:] = old_checkpoints[:i+1], old_horizons[:i+1]
+        spans = self.styler.spans
+        old_data = old_spans.data
+        for j in range(0, len(old_data), 3):
+            if old_data[j] < start:
+                spans.data.extend(old_data[j:j+3])
+
+        # Resynchronize with the previous scan after the edit.
+        threshold = len(s) - suffix + 1
+
+        def resync(loc):
+            if until is not None:
+                until(loc)
+            if loc < threshold:
+                return False
+            j = bisect_right(old_checkpoints, loc - delta) - 1
+            return old_checkpoints[j] == loc - delta
+
+        return self._scan_string(s, start, checkpoints, horizons, resync,
+                                 first if start == 0 else None, deadline)
+
+    def _parse_error(self, s, first):
+        """Returns the exception :meth:`pyparsing.ParserElement.parseString`
+        would raise when parsing a string with :attr:`expr` and `parseAll`, or
+        `None` if there would be none, given the outcome of the first match
+        attempt of a scan of it (see :meth:`_scan_string`). If there is none,
+        e.g. because an incremental scan did not repeat it, since its extent may
+        depend on text past its end, the parser is run again and its outcome
+        stored in `first` for next time."""
+        # pylint: disable=protected-access
+        try:
+            if not first or first[0] is None:
+                try:
+                    loc = self.expr.preParse(s, 0)
+                    loc, _ = self.expr._parse(s, loc, callPreParse=False)
+                except Exception as err:  # pylint: disable=broad-except
+                    loc = err
+                first[:] = [loc]
+            loc = first[0]
+            if isinstance(loc, Exception):
+                return loc
+            loc = self.expr.preParse(s, loc)
+            (pp.Empty() + pp.StringEnd())._parse(s, loc)
+        except Exception as err:  # pylint: disable=broad-except
+            return err
+        return None
+
+    def _lex_shared(self, s, deadline=None):
+        """Highlights a string as :meth:`lex_document` does, returning the
+        fragments and the outcome of the scan's first match attempt, from which
+        :meth:`_parse_error` finds its parse error. The results for the last
+        few strings are kept.
+
+        If `deadline` is given and passes, even while waiting for another
+        thread's call, :class:`_OutOfTime` is raised and nothing is kept but
+        the incremental state to resume from.
+        """
+        result = self._shared.get(s)
+        self._counters.cache_hit = result is not None
+        if result is not None:
+            return result
+        timeout = -1 if deadline is None else max(deadline - time.monotonic(), 0)
+        if not self._shared_lock.acquire(timeout=timeout):
+            err = _OutOfTime(0)
+            err.fragments = [(self._default_style, s)] if s else []
+            raise err
+        try:
+            result = self._shared.get(s)
+            if result is None:
+                first = []
+                if self.incremental:
+                    fragments = self._highlight_incremental(s, first, deadline)
+                else:
+                    fragments = self._highlight(s, first, deadline)
+                result = fragments, first
+                self._shared.put(s, result)
+                self._last_lexed = s, fragments
+            return result
+        finally:
+            self._shared_lock.release()
+
+    def _lex_later(self, s, fragments):
+        """Highlights a string for :meth:`lex_document` in a background thread,
+        then redraws the running prompt_toolkit application. Only the latest
+        string is waited on; ones it supersedes are skipped. Until it is done,
+        :meth:`lex_document` shows the fragments it has highlighted so far,
+        starting with the given ones."""
+        from prompt_toolkit.application.current import get_app_or_none
+        with self._background_lock:
+            if self._scanning is not None:
+                scanning_s, spans = self._scanning
+                if scanning_s == s:
+                    # The string is already being highlighted
+                    self._background = None
+                    return
+                # Abandon the string being highlighted, even partway through
+                # a match, as when out of time
+                spans.deadline = 0
+            running = self._background is not None or self._scanning is not None
+            self._background = s, get_app_or_none()
+            self._progress = s, fragments
+        if not running:
+            thread = threading.Thread(target=self._lex_background, daemon=True)
+            thread.start()
+
+    def _lex_background(self):
+        """Runs in the background thread started by :meth:`_lex_later`."""
+        while True:
+            with self._background_lock:
+                if self._background is None:
+                    self._scanning = None
+                    return
+                s, app = self._background
+                self._background = None
+                spans = _SpanLog()
+                self._scanning = s, spans
+            try:
+                done = self._lex_supersedable(s, spans, app)
+            except Exception as err:  # pylint: disable=broad-except
+                msg = 'Exception during highlighting: {0.__class__.__name__}: {0}'
+                warnings.warn(msg.format(err), RuntimeWarning)
+                done = False
+            with self._background_lock:
+                if self._progress is not None and self._progress[0] == s:
+                    self._progress = None
+            if not done:
+                continue
+            self._redraws += 1
+            if app is not None:
+                app.invalidate()
+
+    def _lex_supersedable(self, s, spans, app):
+        """Highlights a string as :meth:`_lex_shared` does, capturing into
+        `spans`, unless :meth:`_lex_later` supersedes it in the meantime, in
+        which case it is abandoned and `False` is returned. The progress is
+        published every :attr:`progress_interval` seconds.
+
+        The scan runs without holding the lock :meth:`_lex_shared` waits on,
+        which is only taken to publish the results, so :meth:`lex_document`
+        can keep highlighting newer documents meanwhile. When incremental, it
+        resumes from the last results, and if abandoned, leaves its own for
+        the next scan to resume from."""
+        shown = time.monotonic()
+
+        def until(loc):
+            nonlocal shown
+            if self._background is not None:
+                raise _OutOfTime(loc)
+            interval = self.progress_interval
+            if interval is not None and time.monotonic() - shown >= interval:
+                fragments = self._fill_from_last(s, self._gather(s), loc)
+                with self._background_lock:
+                    if self._background is None:
+                        self._progress = s, fragments
+                self._redraws += 1
+                if app is not None:
+                    app.invalidate()
+                shown = time.monotonic()
+            return False
+
+        if self._shared.get(s) is not None:
+            return True
+        first = []
+        state = self._lex_state
+        with self.styler.capture(spans):
+            try:
+                if self.incremental:
+                    new_state = self._scan_incremental(s, state, first, until=until)
+                else:
+                    self._scan_string(s, until=until, first=first)
+            except _OutOfTime as err:
+                if err.state is not None:
+                    with self._shared_lock:
+                        if self._lex_state is state:
+                            self._lex_state = err.state
+                return False
+            fragments = self._gather(s)
+        with self._shared_lock:
+            if self.incremental:
+                self._lex_state = new_state
+            self._shared.put(s, (fragments, first))
+            self._last_lexed = s, fragments
+        return True
+
+    def _fill_from_last(self, s, fragments, loc):
+        """Takes the text fragments of a string highlighted up to `loc`, with
+        the rest unstyled, and returns them with the rest styled as the last
+        document :meth:`lex_document` highlighted in full was, where its text
+        is unchanged. Only the edited text past `loc` is then left unstyled."""
+        last = self._last_lexed
+        if last is None:
+            return fragments
+        old_s, old_fragments = last
+        prefix = _common_prefix_len(old_s, s)
+        suffix = _common_suffix_len(old_s, s, min(len(old_s), len(s)) - prefix)
+        delta = len(s) - len(old_s)
+        loc = min(loc or 0, len(s))
+        result = _slice_fragments(fragments, 0, loc)
+        result.extend(_slice_fragments(old_fragments, loc, prefix))
+        start, end = max(loc, prefix), len(s) - suffix
+        if start < end:
+            result.append((self._default_style, s[start:end]))
+        result.extend(_slice_fragments(old_fragments, max(start, end) - delta, len(old_s)))
+        return result
+
+    def parse_error(self, s):
+        """Returns the exception :meth:`pyparsing.ParserElement.parseString`
+        would raise when parsing a string with :attr:`expr` and `parseAll`, or
+        `None` if it would parse.
+
+        The string is parsed by the same scan that highlights it for
+        :meth:`lex_document`, and the results are kept for the last few
+        strings, so whichever of the two is called second with a string
+        reuses them.
 
-        default_style = Token.Text if self.uses_pygments_tokens else ''
+        Args:
+            s (str): The input string.
 
-        self.styler.clear()
-        self._scan_string(s)
-        locs = self.styler.locs()
-        locs.append(len(s))
+        Returns:
+            Optional[Exception]: The exception, usually a
+            :class:`pyparsing.ParseBaseException`, or `None`.
+        """
+        _, first = self._lex_shared(s)
+        return self._parse_error(s, first)
 
-        i = 0
-        loc = 0
-        fragments = FormattedText()
-        while loc < len(s):
-            fragment = self.styler.get(loc)
-            if fragment:
-                fragments.append(fragment)
-                loc += len(fragment[1])
-                while locs[i] < loc:
-                    i += 1
+    def _lex_lines(self, s, loc=0):
+        """Highlights a string line by line, starting from the line beginning at
+        `loc` and scanning only as far as needed to finish each line. Yields
+        the highlighted lines as lists of prompt_toolkit text fragments.
+
+        Since other highlighting may be done between lines, only the captured
+        fragments which are not yet final are kept between lines.
+        """
+        # pylint: disable=protected-access
+        from prompt_toolkit.formatted_text import split_lines
+        default_style = self._default_style
+        spans = None
+        start = loc
+        line = []
+        split = False
+        while True:
+            end = s.find('\n', start)
+            end = len(s) if end < 0 else end + 1
+            with self.styler.capture(spans) as spans:
+                if loc is not None:
+                    loc = self._scan_string(s, loc, until=lambda loc, end=end: loc >= end)
+                styled = self._resolve(s, start, end if loc is not None else None)
+                chunk = styled._fragments(default_style, start,
+                                         end if loc is not None else None)
+
+                # Rejoin unstyled text that was split at the end of the last line
+                if split and not (styled and styled.starts[0] == start):
+                    line.pop()
+                if chunk:
+                    last = start + sum(len(text) for _, text in chunk[:-1])
+                    start = last + len(chunk[-1][1])
+                    split = not (styled and styled.starts[-1] == last)
+
+                spans = spans.compact(start)
+            *lines, partial = split_lines(self._to_formatted_text(chunk))
+            for next_line in lines:
+                yield line + next_line
+                line = []
+            line += partial
+            if start >= len(s):
+                yield line
+                return
+
+    def _lex_lazy(self, document):
+        """Returns a function which highlights the lines of a document on demand,
+        after the manner of :meth:`prompt_toolkit.lexers.PygmentsLexer.lex_document`.
+        """
+        cache = {}
+        line_generators = {}
+
+        def find_closest_generator(i):
+            for generator, lineno in line_generators.items():
+                if lineno < i and i - lineno < self.REUSE_GENERATOR_MAX_DISTANCE:
+                    return generator
+            return None
+
+        def get_generator(i):
+            generator = find_closest_generator(i)
+            if generator:
+                return generator
+
+            i = max(0, i - self.MIN_LINES_BACKWARDS)
+            if i == 0 or self.syntax_sync is None:
+                row, column = 0, 0
             else:
-                fragments.append((default_style, s[loc:locs[i]]))
-                loc = locs[i]
+                row, column = self.syntax_sync.get_sync_start_position(document, i)
+
+            generator = find_closest_generator(i)
+            if generator:
+                return generator
+            loc = document.translate_row_col_to_index(row, column)
+            generator = enumerate(self._lex_lines(document.text, loc), row)
+
+            # If the column is not 0, ignore the first (incomplete) line.
+            if column:
+                next(generator)
+                row += 1
 
+            line_generators[generator] = row
+            return generator
+
+        def get_line(i):
+            try:
+                return cache[i]
+            except KeyError:
+                if not 0 <= i < document.line_count:
+                    raise IndexError('line index out of range')
+                generator = get_generator(i)
+                for num, line in generator:
+                    cache[num] = line
+                    if num == i:
+                        line_generators[generator] = i
+                        cache.pop(num + 1, None)
+                        return line
+            return []
+
+        return get_line
+
+    def _to_formatted_text(self, fragments):
+        """Converts captured fragments to prompt_toolkit formatted text."""
+        if self.uses_pygments_tokens:
+            from prompt_toolkit.formatted_text import (PygmentsTokens,
+                                                       to_formatted_text)
+            return to_formatted_text(PygmentsTokens(fragments))
         return fragments
 
-    def highlight(self, s):
+    @_observed('highlight')
+    def highlight(self, s, *, budget=None):
         """Highlights a string, returning a list of fragments suitable for
         :func:`prompt_toolkit.print_formatted_text`.
 
         Args:
             s (str): The input string.
+            budget (Optional[float]): The time in seconds to spend
+                highlighting, after which the rest of the string is left
+                unstyled, even partway through a match. Such partial results
+                are not cached. The default of `None` sets no limit.
+
+        Returns:
+            prompt_toolkit.formatted_text.FormattedText: The resulting list of
+            prompt_toolkit text fragments. Its `stopped_at` attribute is where
+            highlighting stopped because the budget ran out, as for
+            :attr:`Spans.stopped_at`, or `None` if it did not.
+        """
+        from prompt_toolkit.formatted_text import FormattedText
+        key = 'text', self.uses_pygments_tokens, s
+        fragments, stopped_at = None, None
+        if self._cache.maxsize:
+            fragments = self._cache.get(key)
+            self._counters.cache_hit = fragments is not None
+        if fragments is None:
+            deadline = None if budget is None else time.monotonic() + budget
+            try:
+                fragments = self._to_formatted_text(self._highlight(s, deadline=deadline))
+            except _OutOfTime as err:
+                fragments = self._to_formatted_text(err.fragments)
+                stopped_at = err.loc
+            else:
+                if self._cache.maxsize:
+                    self._cache.put(key, fragments)
+        self._counters.fragments = len(fragments)
+        result = FormattedText(fragments)
+        result.stopped_at = stopped_at
+        return result
+
+    async def highlight_async(self, s, *, budget=None, executor=None):
+        """Highlights a string as :meth:`highlight` does, in `executor`, so
+        that a running prompt_toolkit application keeps handling input and
+        redrawing while a large string is highlighted.
+
+        Args:
+            s (str): The input string.
+            budget (Optional[float]): As for :meth:`highlight`.
+            executor (Optional[concurrent.futures.Executor]): The executor to
+                highlight in. The default of `None` uses the event loop's
+                default executor.
 
         Returns:
             prompt_toolkit.formatted_text.FormattedText: The resulting list of
             prompt_toolkit text fragments.
         """
-        fragments = self._highlight(s)
-        if self.uses_pygments_tokens:
-            return to_formatted_text(PygmentsTokens(fragments))
-        return fragments
+        import asyncio
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, functools.partial(
+            self.highlight, s, budget=budget))
+
+    def highlight_spans(self, s, *, budget=None):
+        """Highlights a string, returning the locations and styles of its styled
+        spans without copying any of its text.
+
+        Args:
+            s (str): The input string.
+            budget (Optional[float]): The time in seconds to spend
+                highlighting, after which the rest of the string is left
+                unstyled, and :attr:`Spans.stopped_at` is set to where
+                highlighting stopped. The default of `None` sets no limit.
+
+        Returns:
+            Spans: The styled spans, in order.
+        """
+        _check_str(s)
+        deadline = None if budget is None else time.monotonic() + budget
+        with self.styler.capture():
+            try:
+                self._scan_string(s, deadline=deadline)
+            except _OutOfTime as err:
+                spans = self._resolve(s)
+                spans.stopped_at = err.loc
+                return spans
+            return self._resolve(s)
+
+    def highlight_many(self, strings, *, chunksize=16, max_workers=None,
+                       executor=None):
+        """Highlights many strings, spreading them over a pool of worker
+        processes. Each worker builds its own highlighter from
+        :attr:`parser_factory`, which must therefore be picklable (e.g. a
+        module-level function). Small batches are highlighted serially.
+
+        Args:
+            strings (Iterable[str]): The input strings.
+            chunksize (int): The number of strings to send to a worker at once.
+            max_workers (Optional[int]): The number of worker processes to
+                start, by default the number of CPUs.
+            executor (Optional[concurrent.futures.Executor]): An existing pool
+                to use instead of starting one.
+
+        Returns:
+            List[prompt_toolkit.formatted_text.FormattedText]: The resulting
+            lists of prompt_toolkit text fragments, in input order.
+        """
+        return self._map('highlight', {}, strings, chunksize, max_workers,
+                         executor)
+
+    def highlight_html_many(self, strings, *, css_class='highlight',
+                            chunksize=16, max_workers=None, executor=None):
+        """Highlights many strings, returning HTML, spreading them over a pool
+        of worker processes like :meth:`highlight_many`.
+
+        Args:
+            strings (Iterable[str]): The input strings.
+            css_class (str): The CSS class for the wrapping tags.
+            chunksize (int): The number of strings to send to a worker at once.
+            max_workers (Optional[int]): The number of worker processes to
+                start, by default the number of CPUs.
+            executor (Optional[concurrent.futures.Executor]): An existing pool
+                to use instead of starting one.
 
+        Returns:
+            List[str]: The generated HTML, in input order.
+        """
+        return self._map('highlight_html', {'css_class': css_class}, strings,
+                         chunksize, max_workers, executor)
+
+    def _map(self, method, kwargs, strings, chunksize, max_workers, executor):
+        """Calls a highlighting method on each string, in worker processes if
+        there are enough strings to be worth it."""
+        strings = list(strings)
+        workers = max_workers or os.cpu_count() or 1
+        if (executor is None and workers == 1 or len(strings) <= chunksize or
+                sum(map(len, strings)) < self.MIN_PARALLEL_CHARS):
+            func = getattr(self, method)
+            return [func(s, **kwargs) for s in strings]
+
+        options = {'uses_pygments_tokens': self.uses_pygments_tokens,
+                   'sync_points': self.sync_points,
+                   'memo_size': self.styler.memo_size,
+                   'grammar_cache_dir': self.grammar_cache_dir}
+        from concurrent.futures import ProcessPoolExecutor
+        spec = pickle.dumps((self.parser_factory, options))
+        chunks = [strings[i:i+chunksize]
+                  for i in range(0, len(strings), chunksize)]
+        args = [[spec] * len(chunks), [method] * len(chunks),
+                [kwargs] * len(chunks), chunks]
+        if executor is not None:
+            return list(chain.from_iterable(executor.map(_highlight_chunk, *args)))
+        with ProcessPoolExecutor(max_workers) as executor:
+            return list(chain.from_iterable(executor.map(_highlight_chunk, *args)))
+
+    def highlight_stream(self, chunks, *, boundary='\n'):
+        """Highlights a string given as an iterable of chunks, yielding
+        fragments suitable for :func:`prompt_toolkit.print_formatted_text` as
+        soon as they are final. Only the text after the last `boundary` seen so
+        far is kept, so large inputs such as log files can be highlighted in
+        bounded memory.
+
+        The text between each pair of boundaries is highlighted on its own, so
+        the parser never matches across one.
+
+        Args:
+            chunks (Iterable[str]): The input string, in chunks.
+            boundary (str): The boundary the parser never matches across.
+
+        Yields:
+            Tuple[str, str]: The resulting prompt_toolkit text fragments.
+
+        Raises:
+            ValueError: If `boundary` is empty.
+        """
+        for fragments in self._stream(chunks, boundary):
+            yield from self._to_formatted_text(fragments)
+
+    def _stream(self, chunks, boundary):
+        """Highlights a string given as an iterable of chunks, yielding lists of
+        captured fragments as they become final."""
+        if not boundary:
+            raise ValueError('The boundary must not be empty.')
+        default_style = self._default_style
+        pending = ''
+        held, held_len = [], 0
+        for chunk in chain(chunks, [None]):
+            if chunk is None:
+                segments, pending = [pending], ''
+            else:
+                start = max(len(pending) - len(boundary) + 1, 0)
+                pending += chunk
+                if pending.find(boundary, start) < 0:
+                    continue
+                *segments, pending = pending.split(boundary)
+                segments = [segment + boundary for segment in segments]
+
+            # Unstyled text is held back so that runs of it which span
+            # segments come out as single fragments, as from highlight().
+            fragments = []
+            for segment in segments:
+                for style, text in self._highlight(segment) if segment else ():
+                    if style == default_style:
+                        held.append(text)
+                        held_len += len(text)
+                        continue
+                    if held_len:
+                        fragments.append((default_style, ''.join(held)))
+                    held, held_len = [], 0
+                    fragments.append((style, text))
+            if held_len and (chunk is None or held_len > self.MAX_HELD_CHARS):
+                fragments.append((default_style, ''.join(held)))
+                held, held_len = [], 0
+            yield fragments
+
+    def highlight_file(self, path, out, *, format='html', encoding='utf-8',
+                       errors='strict', boundary='\n', css_class='highlight',
+                       chunk_size=2**16, **kwargs):
+        """Highlights a file, writing HTML or terminal output to a text stream.
+
+        The file is memory-mapped and decoded `chunk_size` bytes at a time, and
+        each chunk's output is written as soon as it is final, so memory use
+        does not grow with the size of the file. As with
+        :meth:`highlight_stream`, the text between each pair of boundaries is
+        highlighted on its own; if the parser never matches across a boundary,
+        the HTML output is identical to that of :meth:`highlight_html` on the
+        decoded file.
+
+        Args:
+            path (str): The path of the input file.
+            out: The text stream to write to.
+            format (str): ``'html'`` or ``'ansi'``.
+            encoding (str): The encoding of the input file.
+            errors (str): The error handling scheme to decode with.
+            boundary (str): The boundary the parser never matches across.
+            css_class (str): The CSS class for the wrapping tag, for HTML
+                output.
+            chunk_size (int): The number of bytes to decode at a time.
+            **kwargs: Keyword arguments for :class:`AnsiWriter`, such as
+                `style`, for terminal output.
+
+        Raises:
+            ValueError: If `format` is unknown or `boundary` is empty.
+        """
+        # pylint: disable=redefined-builtin
+        if format not in ('html', 'ansi'):
+            raise ValueError('Unknown output format: {!r}'.format(format))
+        stream = self._stream(_read_chunks(path, encoding, errors, chunk_size),
+                              boundary)
+        if format == 'html':
+            out.write('<pre class="{}">'.format(css_class))
+            for fragments in stream:
+                out.write(''.join(self._html_tags(fragments)))
+            out.write('</pre>')
+            return
+        with AnsiWriter(out, **kwargs) as writer:
+            for fragments in stream:
+                writer.write(self._to_formatted_text(fragments))
+
+    def cache_info(self):
+        """Returns the hit and miss counts and the current and maximum size of
+        the result cache, like :func:`functools.lru_cache`.
+
+        Returns:
+            CacheInfo: A named tuple of `hits`, `misses`, `maxsize`, and
+            `currsize`.
+        """
+        return self._cache.info()
+
+    def cache_clear(self):
+        """Clears the result cache and its statistics."""
+        self._cache.clear()
+
+    def profile_report(self, *, sort_by='self_time'):
+        """Returns the profiles of the parser's styled parse expressions, as
+        recorded while highlighting since the highlighter was constructed with
+        `profile=True` or :meth:`profile_clear` was last called, costliest
+        first.
+
+        Args:
+            sort_by (str): The :class:`ProfileEntry` field to sort by, in
+                descending order.
+
+        Returns:
+            List[ProfileEntry]: The profiles, or an empty list if the
+            highlighter was not constructed with `profile=True`.
+
+        Raises:
+            ValueError: If `sort_by` is not a numeric field of
+                :class:`ProfileEntry`.
+        """
+        fields = ProfileEntry._fields[2:]  # pylint: disable=no-member
+        if sort_by not in fields:
+            raise ValueError('sort_by must be one of {}'.format(', '.join(fields)))
+        return sorted(self.styler.profile(), key=lambda entry: getattr(entry, sort_by),
+                      reverse=True)
+
+    def print_profile(self, *, sort_by='self_time', limit=20, file=sys.stdout):
+        """Prints the costliest entries of :meth:`profile_report` as a table.
+
+        Args:
+            sort_by (str): The :class:`ProfileEntry` field to sort by.
+            limit (Optional[int]): The maximum number of entries to print, or
+                `None` for all of them.
+            file (io.TextIOBase): The stream to print to.
+        """
+        header = '{:>9} {:>9} {:>9} {:>10} {:>10}  {:<20} {}'
+        row = '{:>9} {:>9} {:>9} {:>10.3f} {:>10.3f}  {:<20} {}'
+        print(header.format('attempts', 'successes', 'discarded', 'total ms',
+                            'self ms', 'style', 'element'), file=file)
+        for entry in self.profile_report(sort_by=sort_by)[:limit]:
+            element = str(entry.element)
+            if len(element) > 60:
+                element = element[:57] + '...'
+            print(row.format(entry.attempts, entry.successes, entry.discarded,
+                             entry.total_time * 1000, entry.self_time * 1000,
+                             str(entry.style), element), file=file)
+
+    def profile_clear(self):
+        """Resets the profiles recorded for :meth:`profile_report`."""
+        self.styler.profile_clear()
+
+    @_observed('lex_document')
     def lex_document(self, document):
-        lines = list(split_lines(self.highlight(document.text)))
+        """Takes a :class:`prompt_toolkit.document.Document` and returns a
+        function which returns the highlighted fragments of a given line, as
+        required of a :class:`prompt_toolkit.lexers.Lexer`."""
+        from prompt_toolkit.formatted_text import split_lines
+        _register_lexer()
+        if self.lazy:
+            return self._lex_lazy(document)
+        deadline = None
+        if self.budget is not None:
+            deadline = time.monotonic() + self.budget
+        progress = self._progress
+        if progress is not None and progress[0] == document.text:
+            # Highlighting in the background has not finished
+            fragments = progress[1]
+        else:
+            try:
+                fragments, _ = self._lex_shared(document.text, deadline)
+            except _OutOfTime as err:
+                fragments = self._fill_from_last(document.text, err.fragments, err.loc)
+                self._lex_later(document.text, fragments)
+        self._counters.fragments = len(fragments)
+        lines = list(split_lines(self._to_formatted_text(fragments)))
         return lambda i: lines[i]
 
-    @classmethod
-    def _pygments_css_class(cls, token):
+    def invalidation_hash(self):
+        """Returns a hashable value which changes when the output of
+        :meth:`lex_document` may change, as required of a
+        :class:`prompt_toolkit.lexers.Lexer`. It changes when a document left
+        partly unstyled for lack of time has been highlighted in full."""
+        return id(self), self._redraws
+
+    @staticmethod
+    def _pygments_css_class(token):
         """Returns the standard CSS class name for a Pygments token."""
-        try:
-            return STANDARD_TYPES[token]
-        except KeyError:
-            return cls._pygments_css_class(token.parent)
+        from pygments.token import STANDARD_TYPES
+        while token not in STANDARD_TYPES:
+            token = token.parent
+        return STANDARD_TYPES[token]
 
+    @_observed('highlight_html')
     def highlight_html(self, s, *, css_class='highlight'):
         """Highlights a string, returning HTML.
 
@@ -289,26 +2329,72 @@ class PPHighlighter(Lexer):
         Returns:
             str: The generated HTML.
         """
-        fragments = self._highlight(s)
+        if not self._cache.maxsize:
+            return self._highlight_html(s, css_class)
+        key = 'html', self.uses_pygments_tokens, css_class, s
+        result = self._cache.get(key)
+        self._counters.cache_hit = result is not None
+        if result is None:
+            result = self._highlight_html(s, css_class)
+            self._cache.put(key, result)
+        return result
+
+    def _highlight_html(self, s, css_class):
+        """Highlights a string, returning HTML, without using the cache."""
         tags = ['<pre class="{}">'.format(css_class)]
-        template = '<span class="{}">{}</span>'
-        table = str.maketrans({'.': '-'})
-        for style, text in fragments:
-            classes = []
-            if self.uses_pygments_tokens:
-                classes.append(self._pygments_css_class(style))
-            else:
-                for st in style.split():
-                    if st.startswith('class:'):
-                        classes.append(html.escape(st[6:].translate(table)))
-            if classes and classes[0]:
-                tags.append(template.format(' '.join(classes),
-                                            html.escape(text)))
-            else:
-                tags.append(html.escape(text))
+        fragments = self._highlight(s)
+        self._counters.fragments = len(fragments)
+        tags.extend(self._html_tags(fragments))
         tags.append('</pre>')
         return ''.join(tags)
 
+    def _html_tags(self, fragments):
+        """Converts captured fragments to HTML, yielding one string for each."""
+        prefixes = self._html_prefixes
+        escape = html.escape
+        for style, text in fragments:
+            if style:
+                prefix = prefixes.get(style)
+                if prefix is None:
+                    prefix = prefixes[style] = self._html_prefix(style)
+                if prefix:
+                    yield prefix + escape(text) + '</span>'
+                    continue
+            yield escape(text)
+
+    def _html_prefix(self, style):
+        """Returns the opening tag for a style, or the empty string if the
+        style has no CSS classes."""
+        classes = []
+        if self.uses_pygments_tokens:
+            classes.append(self._pygments_css_class(style))
+        else:
+            table = str.maketrans({'.': '-'})
+            for st in style.split():
+                if st.startswith('class:'):
+                    classes.append(html.escape(st[6:].translate(table)))
+        if classes and classes[0]:
+            return '<span class="{}">'.format(' '.join(classes))
+        return ''
+
+    def highlight_ansi(self, s, *, style=None, color_depth=None):
+        """Highlights a string, returning text with ANSI escape sequences, as
+        written by :class:`AnsiWriter`.
+
+        Args:
+            s (str): The input string.
+            style (prompt_toolkit.styles.BaseStyle): The style to use.
+            color_depth (prompt_toolkit.output.ColorDepth): The color depth to
+                use. The default is 256 colors.
+
+        Returns:
+            str: The highlighted text.
+        """
+        out = io.StringIO()
+        with AnsiWriter(out, style=style, color_depth=color_depth) as writer:
+            writer.write(self.highlight(s))
+        return out.getvalue()
+
     def print(self, *values, file=sys.stdout, **kwargs):
         """Highlights and prints the values to a stream, or to `sys.stdout` by
         default. It calls :func:`prompt_toolkit.print_formatted_text` internally
@@ -321,23 +2407,51 @@ class PPHighlighter(Lexer):
                   style=None, output=None, color_depth=None,
                   style_transformation=None, include_default_pygments_style=None)
         """
-        orig_fileno = None
-
-        # Monkey patch non-tty file objects for compatibility
-        if file is not None:
-            try:
-                file.fileno()
-            except io.UnsupportedOperation:
-                orig_fileno = file.fileno
-                file.fileno = lambda: None
-            if not hasattr(file, 'encoding'):
-                file.encoding = ''
-
-        print_formatted_text(*map(lambda s: self.highlight(str(s)), values),
-                             file=file, **kwargs)
-
-        # Unpatch
-        if orig_fileno is not None:
-            file.fileno = orig_fileno
-        if file is not None and not file.encoding:
-            del file.encoding
+        from prompt_toolkit import print_formatted_text
+        from prompt_toolkit.output.vt100 import Vt100_Output
+        Vt100_Output._fds_not_a_terminal.add(None)  # pylint: disable=protected-access
+        with _patch_file(file):
+            print_formatted_text(*map(lambda s: self.highlight(str(s)), values),
+                                 file=file, **kwargs)
+
+
+class _LexerRegistrar:
+    """An import hook which registers :class:`PPHighlighter` as a virtual
+    subclass of :class:`prompt_toolkit.lexers.Lexer` as soon as that module has
+    been imported, so that it is one whatever the import order, without
+    importing prompt_toolkit before it is needed."""
+
+    @staticmethod
+    def find_spec(fullname, path, target=None):
+        """Finds the module spec of :mod:`prompt_toolkit.lexers` with the
+        other finders on :data:`sys.meta_path`, and makes its loader register
+        :class:`PPHighlighter` after executing it."""
+        if fullname != 'prompt_toolkit.lexers':
+            return None
+        for finder in sys.meta_path:
+            if finder is _LexerRegistrar or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        exec_module = getattr(spec.loader, 'exec_module', None)
+        if exec_module is None:
+            # PPHighlighter is then registered when constructed or first lexes
+            return None
+
+        def exec_and_register(module):
+            exec_module(module)
+            if _LexerRegistrar in sys.meta_path:
+                sys.meta_path.remove(_LexerRegistrar)
+            _register_lexer()
+
+        spec.loader.exec_module = exec_and_register
+        return spec
+
+
+if 'prompt_toolkit.lexers' in sys.modules:
+    _register_lexer()
+elif _LexerRegistrar not in sys.meta_path:
+    sys.meta_path.insert(0, _LexerRegistrar)
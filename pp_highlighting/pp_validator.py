@@ -1,8 +1,17 @@
 """A prompt_toolkit Validator for pyparsing."""
 
+import asyncio
+from bisect import bisect_right
+import threading
+import time
+import warnings
+
 from prompt_toolkit.validation import Validator, ValidationError
 import pyparsing as pp
 
+from .pp_highlighter import _common_prefix_len, _LRUCache, PPHighlighter
+from .telemetry import CallStats
+
 __all__ = ['PPValidator']
 
 
@@ -11,33 +20,208 @@ class PPValidator(Validator):
     _fmt_multiline = '(line:{}, col:{}) {}'
     _fmt_oneline = '(col:{}) {}'
 
-    def __init__(self, expr, *, multiline=True, move_cursor_to_end=False):
+    def __init__(self, expr, *, multiline=True, move_cursor_to_end=False,
+                 cache_size=0, incremental=False, executor=None, debounce=0,
+                 observer=None):
         """Constructs a new :class:`PPValidator`.
 
         Args:
-            expr (pyparsing.ParserElement): The parser to use for validation.
+            expr (Union[pyparsing.ParserElement, PPHighlighter]): The parser
+                to use for validation, or a highlighter whose parser to use.
+                Given a highlighter, the validator finds errors with
+                :meth:`PPHighlighter.parse_error`, sharing one parse of each
+                document with the highlighter's lexer, and `incremental` is
+                ignored.
             multiline (bool): Whether to include the line number in the error
                 message.
             move_cursor_to_end (bool): Whether to move the cursor to the end
                 of the input if a non-pyparsing exception was raised during
                 parsing.
+            cache_size (int): The maximum number of results of validation to
+                cache, keyed by input text, so that e.g. moving the cursor does
+                not parse the text again. The default of 0 disables caching.
+            incremental (bool): Whether to remember where the statements of
+                the last text validated ended, and re-parse only from the last
+                one before an edit. Only applies if `expr` is a
+                :class:`pyparsing.ZeroOrMore` or :class:`pyparsing.OneOrMore`
+                of statements with no parse action, and assumes that whether
+                a statement matches does not depend on the statements before
+                it or on the text past the statement after it.
+            executor (Optional[concurrent.futures.Executor]): The executor
+                :meth:`validate_async` parses in. The default of `None` uses
+                the event loop's default executor.
+            debounce (float): The number of seconds :meth:`validate_async`
+                waits before parsing, so that a document superseded in the
+                meantime, e.g. by another keystroke, is not parsed at all.
+            observer (Optional[Callable[[CallStats], None]]): Called with the
+                statistics of each validation, whether by :meth:`validate` or
+                :meth:`validate_async`, e.g. an
+                :class:`Aggregator`.
         """
+        self.highlighter = None
+        if isinstance(expr, PPHighlighter):
+            self.highlighter, expr = expr, expr.expr
         self.expr = expr
         self.move_cursor_to_end = move_cursor_to_end
         self.multiline = multiline
+        self.incremental = incremental
+        self._cache = _LRUCache(cache_size)
+        self._last = None
+        self.executor = executor
+        self.debounce = debounce
+        self._generation = 0
+        self._lock = threading.RLock()
+        self.observer = observer
 
     def __repr__(self):
         return '{0.__class__.__name__}({0.expr!r})'.format(self)
 
     def validate(self, document):
-        try:
-            self.expr.parseString(document.text, parseAll=True)
-        except pp.ParseBaseException as err:
+        result = self._validate_cached(document.text)
+        if result:
+            raise ValidationError(*result)
+
+    async def validate_async(self, document):
+        """Validates a document in :attr:`executor`, after waiting
+        :attr:`debounce` seconds.
+
+        Each call supersedes those before it. A superseded call returns
+        without raising as soon as it is noticed, and its result, which would
+        be stale, is discarded; if it has not started parsing, it never does.
+        A parse already in progress cannot be interrupted, but the newer
+        document is parsed as soon as it finishes. prompt_toolkit's
+        :class:`Buffer` validates again when its document changed during
+        validation, so it never reports a superseded result either.
+
+        Raises:
+            ValidationError: If the document is invalid and the call was not
+                superseded.
+        """
+        self._generation += 1
+        generation = self._generation
+        if self.debounce > 0:
+            await asyncio.sleep(self.debounce)
+            if generation != self._generation:
+                return
+        loop = asyncio.get_event_loop()
+        result = await loop.run_in_executor(self.executor, self._validate_latest,
+                                            document.text, generation)
+        if result and generation == self._generation:
+            raise ValidationError(*result)
+
+    def _validate_latest(self, text, generation):
+        """Validates a string as :meth:`_validate_cached` does, unless the
+        call to :meth:`validate_async` with the given generation has been
+        superseded, in which case `None` is returned."""
+        with self._lock:
+            if generation != self._generation:
+                return None
+            return self._validate_cached(text)
+
+    def _validate_cached(self, text):
+        """Validates a string as :meth:`_validate` does, using and updating
+        the cache of results, and reports the call to :attr:`observer`."""
+        start = time.perf_counter()
+        with self._lock:
+            cache_hit = None
+            if not self._cache.maxsize:
+                result = self._validate(text)
+            else:
+                result = self._cache.get(text)
+                cache_hit = result is not None
+                if result is None:
+                    result = self._validate(text)
+                    self._cache.put(text, result)
+        if self.observer is not None:
+            stats = CallStats('validate', len(text), None, None,
+                              time.perf_counter() - start, cache_hit)
+            try:
+                self.observer(stats)
+            except Exception as err:  # pylint: disable=broad-except
+                msg = 'Exception in observer: {0.__class__.__name__}: {0}'
+                warnings.warn(msg.format(err), RuntimeWarning)
+        return result
+
+    def _validate(self, text):
+        """Validates a string, returning the cursor position and message of the
+        validation error, or an empty tuple if it is valid."""
+        error = None
+        if self.highlighter is not None:
+            error = self.highlighter.parse_error(text)
+        else:
+            try:
+                if self.incremental and self._is_statements():
+                    self._parse_statements(text)
+                else:
+                    self.expr.parseString(text, parseAll=True)
+            except Exception as err:  # pylint: disable=broad-except
+                error = err
+        if error is None:
+            return ()
+        if isinstance(error, pp.ParseBaseException):
             if self.multiline:
-                msg = self._fmt_multiline.format(err.lineno, err.column, err.msg)
+                msg = self._fmt_multiline.format(error.lineno, error.column, error.msg)
             else:
-                msg = self._fmt_oneline.format(err.column, err.msg)
-            raise ValidationError(err.loc, msg)
-        except Exception as err:  # pylint: disable=broad-except
-            i = len(document.text) if self.move_cursor_to_end else 0
-            raise ValidationError(i, '{}: {}'.format(type(err).__name__, err))
+                msg = self._fmt_oneline.format(error.column, error.msg)
+            return error.loc, msg
+        i = len(text) if self.move_cursor_to_end else 0
+        return i, '{}: {}'.format(type(error).__name__, error)
+
+    def _is_statements(self):
+        """Returns whether the parser is a repetition of statements that can be
+        parsed incrementally."""
+        return (isinstance(self.expr, (pp.ZeroOrMore, pp.OneOrMore))
+                and not self.expr.parseAction)
+
+    def _parse_statements(self, text):
+        """Parses a string as :meth:`pyparsing.ParserElement.parseString` does
+        with `parseAll`, resuming after the last statement that the previous
+        string's parse matched before the edit.
+
+        Adapted from :meth:`pyparsing.OneOrMore.parseImpl`.
+        """
+        # pylint: disable=protected-access
+        expr = self.expr
+        pp.ParserElement.resetCache()
+        if not expr.streamlined:
+            expr.streamline()
+        for e in expr.ignoreExprs:
+            e.streamline()
+        s = text if expr.keepTabs else text.expandtabs()
+
+        # Back off one statement, since a statement may have looked ahead past
+        # its end (e.g. for another repetition) without it showing.
+        ends = []
+        if self._last is not None:
+            old_s, old_ends = self._last
+            i = bisect_right(old_ends, _common_prefix_len(old_s, s)) - 1
+            ends = old_ends[:max(i, 0)]
+        self._last = s, ends
+
+        not_ender = getattr(expr, 'not_ender', None)
+        parse = expr.expr._parse
+        if not ends:
+            loc = expr.preParse(s, 0)
+            try:
+                if not_ender is not None:
+                    not_ender.tryParse(s, loc)
+                loc, _ = parse(s, loc, True, False)
+                ends.append(loc)
+            except (pp.ParseException, IndexError):
+                if isinstance(expr, pp.OneOrMore):
+                    raise
+        if ends:
+            loc = ends[-1]
+            try:
+                while True:
+                    if not_ender is not None:
+                        not_ender.tryParse(s, loc)
+                    if expr.ignoreExprs:
+                        loc = expr._skipIgnorables(s, loc)
+                    loc, _ = parse(s, loc, True)
+                    ends.append(loc)
+            except (pp.ParseException, IndexError):
+                loc = ends[-1]
+
+        loc = expr.preParse(s, loc)
+        (pp.Empty() + pp.StringEnd())._parse(s, loc)
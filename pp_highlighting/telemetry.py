@@ -0,0 +1,154 @@
+"""Statistics on highlighting and validation calls, for monitoring.
+
+:class:`PPHighlighter` and :class:`PPValidator` take an `observer`, a callable
+which is passed a :class:`CallStats` after each call to their main methods.
+:class:`Aggregator` is an observer which keeps statistics in memory and
+summarizes them, e.g. as latency percentiles.
+"""
+
+from collections import deque, namedtuple
+import threading
+
+__all__ = ['Aggregator', 'CallStats']
+
+CallStats = namedtuple('CallStats', 'operation length fragments failures time cache_hit')
+CallStats.__doc__ = """Statistics on one call to a highlighting or validation
+method.
+
+Attributes:
+    operation (str): The method called: ``'highlight'``,
+        ``'highlight_html'``, ``'lex_document'``, or ``'validate'``.
+    length (int): The length of the input string in characters.
+    fragments (Optional[int]): The number of text fragments in the result, or
+        `None` if it is not known, e.g. because the result came from the cache
+        as HTML or because lines are highlighted lazily.
+    failures (Optional[int]): The number of locations the parser failed to
+        match at, after which scanning restarted further on, or `None` if the
+        input was not scanned for highlighting.
+    time (float): The time the call took, in seconds.
+    cache_hit (Optional[bool]): Whether the result came from a cache, or
+        `None` if no cache was consulted.
+"""
+
+
+def _percentile(values, percent):
+    """Returns a percentile of a sorted list of values, interpolating linearly
+    between the closest ranks."""
+    k = (len(values) - 1) * percent / 100
+    i = int(k)
+    if i + 1 >= len(values):
+        return values[-1]
+    return values[i] + (values[i+1] - values[i]) * (k - i)
+
+
+class Aggregator:
+    """An observer which aggregates call statistics in memory.
+
+    Totals cover every call, while percentiles are computed over the most
+    recent calls of each operation. It may be shared by several highlighters
+    and validators, and used from several threads at once.
+
+    Examples:
+
+        >>> aggregator = Aggregator()
+        >>> pph = PPHighlighter(parser_factory, observer=aggregator)
+        >>> fragments = pph.highlight('1, 2, 3')
+        >>> aggregator.percentiles('highlight')
+        {50: 0.00012, 90: 0.00012, 99: 0.00012}
+    """
+
+    def __init__(self, window=10000):
+        """Constructs a new :class:`Aggregator`.
+
+        Args:
+            window (int): The number of most recent calls of each operation to
+                compute percentiles over.
+        """
+        self.window = window
+        self._lock = threading.Lock()
+        self._recent = {}
+        self._totals = {}
+
+    def __call__(self, stats):
+        """Records the statistics of a call.
+
+        Args:
+            stats (CallStats): The statistics.
+        """
+        with self._lock:
+            recent = self._recent.get(stats.operation)
+            if recent is None:
+                recent = self._recent[stats.operation] = deque(maxlen=self.window)
+                self._totals[stats.operation] = [0, 0, 0.0, 0, 0]
+            recent.append(stats)
+            totals = self._totals[stats.operation]
+            totals[0] += 1
+            totals[1] += stats.length
+            totals[2] += stats.time
+            if stats.cache_hit is not None:
+                totals[3 if stats.cache_hit else 4] += 1
+
+    def operations(self):
+        """Returns the operations that calls have been recorded for.
+
+        Returns:
+            List[str]: The operations, sorted.
+        """
+        with self._lock:
+            return sorted(self._totals)
+
+    def percentiles(self, operation, field='time', percents=(50, 90, 99)):
+        """Returns percentiles of a statistic over the most recent calls of an
+        operation.
+
+        Args:
+            operation (str): The operation.
+            field (str): The :class:`CallStats` field to compute percentiles
+                of. Calls for which it is `None` are left out.
+            percents (Iterable[float]): The percentiles to compute, from 0 to
+                100.
+
+        Returns:
+            Dict[float, float]: The percentiles, by percent. The dict is empty
+            if no calls were recorded.
+        """
+        with self._lock:
+            recent = list(self._recent.get(operation, ()))
+        values = sorted(getattr(stats, field) for stats in recent
+                        if getattr(stats, field) is not None)
+        if not values:
+            return {}
+        return {percent: _percentile(values, percent) for percent in percents}
+
+    def summary(self, operation):
+        """Summarizes the calls of an operation.
+
+        Args:
+            operation (str): The operation.
+
+        Returns:
+            Dict[str, float]: The number of calls (`count`), their total time
+            (`total_time`), the number of input characters per second of it
+            (`throughput`), the fraction of calls that consulted a cache which
+            hit it (`cache_hit_rate`, or `None`), and the 50th, 90th, and 99th
+            percentiles of time taken (`p50`, `p90`, and `p99`).
+
+        Raises:
+            KeyError: If no calls of the operation were recorded.
+        """
+        with self._lock:
+            count, length, total_time, hits, misses = self._totals[operation]
+        percentiles = self.percentiles(operation)
+        return {'count': count,
+                'total_time': total_time,
+                'throughput': length / total_time if total_time else None,
+                'cache_hit_rate': hits / (hits + misses) if hits + misses else None,
+                'p50': percentiles[50],
+                'p90': percentiles[90],
+                'p99': percentiles[99]}
+
+    def clear(self):
+        """Discards all recorded statistics."""
+        with self._lock:
+            self._recent.clear()
+            self._totals.clear()
@@ -1,22 +1,59 @@
-"""A PPHighlighter benchmark."""
+"""A benchmark suite for pyparsing-highlighting.
 
-# pylint: disable=no-name-in-module
+Each example grammar, and some synthetic worst cases, are timed at several
+input sizes, so that the results show how each operation scales:
+:meth:`PPHighlighter.highlight`, :meth:`PPHighlighter.highlight_html`,
+:meth:`PPHighlighter.lex_document`, :meth:`PPHighlighter.print`,
+:meth:`PPValidator.validate`, and plain parsing with the parser built with
+:data:`dummy_styler` (`parse`) and with :attr:`PPHighlighter.expr`
+(`parse_shared`). Run it from the project root directory::
 
+    python3 -m tests.benchmark run -o before.json
+    python3 -m tests.benchmark run -o after.json
+    python3 -m tests.benchmark compare before.json after.json
+
+`compare` flags the timings which got slower by more than a threshold (10% by
+default), and exits with status 1 if there are any. `run` likewise flags the
+cases where parsing with :attr:`PPHighlighter.expr` is slower than parsing with
+the parser built with :data:`dummy_styler` by more than a threshold (50% by
+default), as sharing the parser is meant to cost little, and exits with status
+1 if there are any.
+"""
+
+# pylint: disable=no-name-in-module, protected-access
+
+import argparse
+from collections import namedtuple
+import io
+import json
+import os
+import platform
 import random
+import statistics
+import subprocess
+import sys
 import time
+import warnings
 
-from pygments import highlight
-from pygments.formatters import Terminal256Formatter
-from pygments.lexers import Python3Lexer
+from prompt_toolkit.document import Document
+from prompt_toolkit.output import ColorDepth
+from prompt_toolkit.validation import ValidationError
 import pyparsing as pp
 from pyparsing import pyparsing_common as ppc
 
-from pp_highlighting import dummy_styler, PPHighlighter
+from examples import calc, json_pph, repr as repr_example, sexp
+from pp_highlighting import dummy_styler, PPHighlighter, PPValidator
 
 N_RUNS = 5
+SIZES = [1000, 4000, 16000]
+WORST_CASE_SIZES = [25, 50, 100]
+THRESHOLD = 0.1
+SHARED_THRESHOLD = 0.5
 
+Case = namedtuple('Case', 'name parser_factory make_input sizes valid')
 
-def parser_factory(styler):
+
+def nested_list_parser_factory(styler):
     """Builds a parser for nested comma-separated lists of integers (like
     [1, 2, [3]]).
     """
@@ -25,43 +62,297 @@ def parser_factory(styler):
     integer = styler('class:int', ppc.integer)
     lst <<= LBRK + pp.Optional(pp.delimitedList(integer | lst)) + RBRK
     lst.addParseAction(lambda t: [list(t)])
-    lst.validate()
     return lst
 
 
+def repeat(size, rng, make_item, sep, start='', end=''):
+    """Joins items made by a function until the result is at least `size`
+    characters long."""
+    items, length = [], len(start) + len(end)
+    while length < size:
+        items.append(make_item(rng))
+        length += len(items[-1]) + len(sep)
+    return start + sep.join(items) + end
+
+
+def random_object(rng, depth=0):
+    """Returns a random JSON-compatible object."""
+    kind = rng.randrange(7 if depth < 3 else 5)
+    if kind == 0:
+        return rng.randrange(-1000, 1000)
+    if kind == 1:
+        return rng.random() * 100
+    if kind == 2:
+        return 'str\t"{}"'.format(rng.randrange(1000))
+    if kind == 3:
+        return rng.choice([True, False, None])
+    if kind == 4:
+        return 'x' * rng.randrange(10)
+    if kind == 5:
+        return [random_object(rng, depth + 1) for _ in range(rng.randrange(5))]
+    return {'k{}'.format(i): random_object(rng, depth + 1)
+            for i in range(rng.randrange(5))}
+
+
+def calc_term(rng, depth=0):
+    """Returns a random calculator expression."""
+    if depth < 3 and rng.random() < 0.3:
+        return '({} {} {})'.format(calc_term(rng, depth + 1), rng.choice('+-*/'),
+                                   calc_term(rng, depth + 1))
+    return rng.choice(['', '-']) + str(round(rng.uniform(1, 100), rng.randrange(3)))
+
+
+def sexp_form(rng, depth=0):
+    """Returns a random S-expression."""
+    if depth < 3 and rng.random() < 0.4:
+        items = [sexp_form(rng, depth + 1) for _ in range(rng.randrange(1, 5))]
+        return '(f{} {})'.format(rng.randrange(10), ' '.join(items))
+    return rng.choice(['nil', 't', '"a string"', "'quoted", 'symbol',
+                       str(rng.randrange(1000)), '2.5e3'])
+
+
+def nested_list(rng, depth=0):
+    """Returns a random nested list of integers."""
+    if depth < 3 and rng.random() < 0.3:
+        return [nested_list(rng, depth + 1) for _ in range(rng.randrange(5))]
+    return rng.randrange(1000)
+
+
+CASES = [
+    Case('calc', calc.parser_factory,
+         lambda size, rng: repeat(size, rng, calc_term, ' + '), SIZES, True),
+    Case('json', json_pph.parser_factory,
+         lambda size, rng: repeat(size, rng, lambda rng: json.dumps(random_object(rng)),
+                                  ', ', '[', ']'), SIZES, True),
+    Case('sexp', sexp.parser_factory,
+         lambda size, rng: repeat(size, rng, sexp_form, ' ', '(progn ', ')'), SIZES, True),
+    Case('repr', repr_example.parser_factory,
+         lambda size, rng: repeat(size, rng, lambda rng: repr(random_object(rng)),
+                                  ', ', '[', ']'), SIZES, False),
+    Case('nested_list', nested_list_parser_factory,
+         lambda size, rng: repeat(size, rng, lambda rng: str(nested_list(rng)),
+                                  ', ', '[', ']'), SIZES, True),
+    # Every location starts a match attempt which fails only at the end
+    Case('sexp_unbalanced', sexp.parser_factory,
+         lambda size, rng: '(' * size, WORST_CASE_SIZES, False),
+    # Most locations cannot start a match at all
+    Case('json_garbage', json_pph.parser_factory,
+         lambda size, rng: ''.join(rng.choice('ab,:;"\\ \n{[') for _ in range(size)),
+         SIZES, False),
+]
+
+
+def validate(ppv, document):
+    """Validates a document, returning whether it is valid."""
+    try:
+        ppv.validate(document)
+    except ValidationError:
+        return False
+    return True
+
+
+def parse_string(parser, s):
+    """Parses a string, returning whether it is valid, or `None` if it nests
+    too deeply to parse."""
+    try:
+        parser.parseString(s, parseAll=True)
+    except pp.ParseBaseException:
+        return False
+    except RecursionError:
+        return None
+    return True
+
+
+def operations(case, s):
+    """Returns the operations to time on an input string, by name. Nothing is
+    cached between runs."""
+    pph = PPHighlighter(case.parser_factory)
+    parser = case.parser_factory(dummy_styler)
+    ppv = PPValidator(parser)
+
+    def highlight():
+        return pph.highlight(s)
+
+    def highlight_html():
+        return pph.highlight_html(s)
+
+    def lex_document():
+        pph._shared.clear()
+        document = Document(s)
+        lines = pph.lex_document(document)
+        return [lines(i) for i in range(document.line_count)]
+
+    def print_():
+        out = io.StringIO()
+        pph.print(s, file=out, color_depth=ColorDepth.TRUE_COLOR)
+        return out.getvalue()
+
+    def validate_():
+        return validate(ppv, Document(s))
+
+    def parse():
+        return parse_string(parser, s)
+
+    def parse_shared():
+        return parse_string(pph.expr, s)
+
+    return {'highlight': highlight, 'highlight_html': highlight_html,
+            'lex_document': lex_document, 'print': print_, 'validate': validate_,
+            'parse': parse, 'parse_shared': parse_shared}
+
+
+def check(case, s, results):
+    """Checks the results of the operations on an input string."""
+    text = ''.join(text for _, text in results['highlight'])
+    assert text == s, '{}: highlight() changed the text'.format(case.name)
+    assert results['validate'] == case.valid, \
+        '{}: validate() returned {}'.format(case.name, results['validate'])
+
+
+def time_runs(func, n_runs):
+    """Returns the times taken by a function over a number of runs, and its
+    last result."""
+    times = []
+    for _ in range(n_runs):
+        t1 = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - t1)
+    return times, result
+
+
+def git_commit():
+    """Returns the current git commit hash, or `None` if it is unknown."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        out = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, check=True,
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def run(args):
+    """Runs the benchmarks, printing the results and writing them as JSON."""
+    warnings.simplefilter('ignore', RuntimeWarning)
+    results, slow_shared = [], 0
+    print('{:<16} {:>6}  {:<15} {:>10} {:>10}'.format(
+        'case', 'size', 'operation', 'median ms', 'min ms'))
+    for case in CASES:
+        if args.cases and case.name not in args.cases:
+            continue
+        for size in case.sizes:
+            s = case.make_input(size, random.Random(size))
+            funcs, last = operations(case, s), {}
+            for name, func in funcs.items():
+                if args.operations and name not in args.operations:
+                    continue
+                times, last[name] = time_runs(func, args.runs)
+                result = {'case': case.name, 'size': len(s), 'operation': name,
+                          'median': statistics.median(times), 'min': min(times),
+                          'runs': args.runs}
+                results.append(result)
+                print('{:<16} {:>6}  {:<15} {:>10.3f} {:>10.3f}'.format(
+                    case.name, len(s), name, result['median'] * 1000,
+                    result['min'] * 1000))
+            if len(last) == len(funcs):
+                check(case, s, last)
+            timed = {r['operation']: r['median'] for r in results[-len(last):]}
+            if 'parse' in timed and 'parse_shared' in timed:
+                ratio = timed['parse_shared'] / timed['parse']
+                flag = ''
+                if last['parse_shared'] != last['parse']:
+                    # The grammar differs, e.g. sexp's accepts unclosed lists
+                    flag = '  (not comparable)'
+                elif ratio > 1 + args.shared_threshold:
+                    flag = '  SLOW'
+                    slow_shared += 1
+                print('{:<16} {:>6}  {:<15} {:>20.2f}x{}'.format(
+                    case.name, len(s), 'shared/parse', ratio, flag))
+
+    meta = {'commit': git_commit(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'pyparsing': pp.__version__,
+            'platform': platform.platform()}
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=1)
+            f.write('\n')
+        print('Wrote results to {}'.format(args.output))
+    if slow_shared:
+        print('{} case(s) parse slower with PPHighlighter.expr by over {:.0%}'.format(
+            slow_shared, args.shared_threshold))
+    return 1 if slow_shared else 0
+
+
+def compare(args):
+    """Compares two results files, printing the ratio of each pair of median
+    times, and returns 1 if any is a regression over the threshold."""
+    def load(path):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        return data['meta'], {(r['case'], r['operation'], r['size']): r
+                              for r in data['results']}
+
+    old_meta, old = load(args.old)
+    new_meta, new = load(args.new)
+    print('old: {} ({})'.format(old_meta.get('commit'), old_meta.get('date')))
+    print('new: {} ({})'.format(new_meta.get('commit'), new_meta.get('date')))
+    print('{:<16} {:>6}  {:<15} {:>10} {:>10} {:>7}'.format(
+        'case', 'size', 'operation', 'old ms', 'new ms', 'ratio'))
+    regressions = 0
+    for key in sorted(old.keys() & new.keys()):
+        case, operation, size = key
+        t_old, t_new = old[key]['median'], new[key]['median']
+        ratio = t_new / t_old if t_old else float('inf')
+        flag = ''
+        if ratio > 1 + args.threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        elif ratio < 1 / (1 + args.threshold):
+            flag = '  improvement'
+        print('{:<16} {:>6}  {:<15} {:>10.3f} {:>10.3f} {:>6.2f}x{}'.format(
+            case, size, operation, t_old * 1000, t_new * 1000, ratio, flag))
+    for key in sorted(old.keys() ^ new.keys()):
+        case, operation, size = key
+        print('{:<16} {:>6}  {:<15} only in {}'.format(
+            case, size, operation, 'old' if key in old else 'new'))
+    print('{} regression(s) over {:.0%}'.format(regressions, args.threshold))
+    return 1 if regressions else 0
+
+
 def main():
     """The main function."""
-    expr = parser_factory(dummy_styler)
-    pph = PPHighlighter(parser_factory)
-    lexer = Python3Lexer()
-    formatter = Terminal256Formatter()
-
-    # Generate the test data
-    random.seed(0)
-    data = [[random.randrange(1000) for _ in range(100)] for _ in range(100)]
-    s = str(data)
-
-    # Perform the benchmarks
-    t1 = time.perf_counter()
-    for _ in range(N_RUNS):
-        result = expr.parseString(s, parseAll=True)[0]
-    t2 = time.perf_counter()
-    for _ in range(N_RUNS):
-        fragments = pph.highlight(s)
-    t3 = time.perf_counter()
-    for _ in range(N_RUNS):
-        highlight(s, lexer, formatter)
-    t4 = time.perf_counter()
-
-    # Verify the results
-    assert data == result
-    assert s == ''.join(text for _, text in fragments)
-
-    # Display the results
-    print('Input string size: {} chars'.format(len(s)))
-    print('Parsing completed in {:.3f}ms'.format((t2 - t1) / N_RUNS * 1000))
-    print('Highlighting completed in {:.3f}ms'.format((t3 - t2) / N_RUNS * 1000))
-    print('Pygments highlighting completed in {:.3f}ms'.format((t4 - t3) / N_RUNS * 1000))
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('-o', '--output', help='the JSON file to write results to')
+    run_parser.add_argument('--runs', type=int, default=N_RUNS,
+                            help='the number of runs of each benchmark')
+    run_parser.add_argument('--cases', nargs='+', choices=[case.name for case in CASES],
+                            help='the cases to run (by default, all)')
+    run_parser.add_argument('--operations', nargs='+',
+                            choices=['highlight', 'highlight_html', 'lex_document',
+                                     'print', 'validate', 'parse', 'parse_shared'],
+                            help='the operations to time (by default, all)')
+    run_parser.add_argument('--shared-threshold', type=float, default=SHARED_THRESHOLD,
+                            help='the slowdown of parse_shared over parse to flag, as '
+                            'a fraction (default: %(default)s)')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser('compare', help='compare two results files')
+    compare_parser.add_argument('old', help='the baseline results')
+    compare_parser.add_argument('new', help='the results to check')
+    compare_parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                                help='the slowdown to flag, as a fraction '
+                                '(default: %(default)s)')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
 
 
 if __name__ == '__main__':
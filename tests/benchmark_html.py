@@ -0,0 +1,84 @@
+"""A benchmark of HTML generation from captured fragments, comparing the
+compiled style-to-markup cache with converting each fragment's style anew."""
+
+# pylint: disable=no-name-in-module, protected-access
+
+import html
+import random
+import time
+
+from pygments.token import STANDARD_TYPES, Token
+
+from pp_highlighting import PPHighlighter
+
+N_RUNS = 5
+N_FRAGMENTS = 200000
+
+STYLES = ['', 'class:int', 'class:float', 'class:string',
+          'class:keyword.constant', 'class:op bold', 'class:name.builtin']
+TOKENS = [Token.Text, Token.Number.Integer, Token.Number.Float,
+          Token.Literal.String, Token.Keyword.Constant, Token.Operator,
+          Token.Name.Builtin]
+
+
+def pygments_css_class(token):
+    """Returns the standard CSS class name for a Pygments token."""
+    try:
+        return STANDARD_TYPES[token]
+    except KeyError:
+        return pygments_css_class(token.parent)
+
+
+def uncached_html_tags(fragments, uses_pygments_tokens):
+    """Converts fragments to HTML, splitting, escaping, and translating each
+    fragment's style every time."""
+    template = '<span class="{}">{}</span>'
+    table = str.maketrans({'.': '-'})
+    for style, text in fragments:
+        classes = []
+        if uses_pygments_tokens:
+            classes.append(pygments_css_class(style))
+        else:
+            for st in style.split():
+                if st.startswith('class:'):
+                    classes.append(html.escape(st[6:].translate(table)))
+        if classes and classes[0]:
+            yield template.format(' '.join(classes), html.escape(text))
+        else:
+            yield html.escape(text)
+
+
+def bench(func):
+    """Returns the mean time taken by a function over N_RUNS runs, and its
+    result."""
+    t1 = time.perf_counter()
+    for _ in range(N_RUNS):
+        result = func()
+    t2 = time.perf_counter()
+    return (t2 - t1) / N_RUNS, result
+
+
+def main():
+    """The main function."""
+    random.seed(0)
+    words = ['1', '2.5', '"a<b"', 'None', '+', 'len', ' ', ', ', '\n']
+
+    for name, styles, uses_pygments_tokens in [('class', STYLES, False),
+                                               ('Pygments', TOKENS, True)]:
+        pph = PPHighlighter(lambda styler: styler('', 'a'),
+                            uses_pygments_tokens=uses_pygments_tokens)
+        fragments = [(random.choice(styles), random.choice(words))
+                     for _ in range(N_FRAGMENTS)]
+        t_old, expected = bench(lambda: ''.join(
+            uncached_html_tags(fragments, uses_pygments_tokens)))
+        t_new, result = bench(lambda: ''.join(pph._html_tags(fragments)))
+        assert result == expected
+
+        print('{} styles, {} fragments:'.format(name, N_FRAGMENTS))
+        print('  Uncached completed in {:.3f}ms'.format(t_old * 1000))
+        print('  Compiled completed in {:.3f}ms ({:.2f}x)'.format(
+            t_new * 1000, t_old / t_new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""A benchmark of the time taken to import pp_highlighting and highlight a
+string to HTML, compared with importing prompt_toolkit as well, as it did
+before its imports were made lazy. Each import is timed in a new interpreter.
+"""
+
+import statistics
+import subprocess
+import sys
+
+N_RUNS = 10
+
+SETUP = 'import time; t = time.perf_counter(); '
+REPORT = '; print(time.perf_counter() - t)'
+
+HTML_ONLY = ('import sys; import pyparsing as pp; import pp_highlighting; '
+             'pph = pp_highlighting.PPHighlighter(lambda s: s("class:a", "a")); '
+             'pph.highlight_html("a")')
+CHECK = ('; assert not {"asyncio", "prompt_toolkit", "pygments"} & set(sys.modules), '
+         '"asyncio, prompt_toolkit or Pygments was imported"')
+EAGER = 'import prompt_toolkit, pygments.token; ' + HTML_ONLY
+
+
+def bench(code):
+    """Returns the median time taken to run some code in a new interpreter."""
+    times = []
+    for _ in range(N_RUNS):
+        out = subprocess.run([sys.executable, '-c', SETUP + code + REPORT],
+                             check=True, stdout=subprocess.PIPE)
+        times.append(float(out.stdout))
+    return statistics.median(times)
+
+
+def main():
+    """The main function."""
+    t_lazy = bench(HTML_ONLY + CHECK)
+    t_eager = bench(EAGER)
+    print('Import and highlight_html() completed in {:.1f}ms'.format(t_lazy * 1000))
+    print('With prompt_toolkit imported: {:.1f}ms ({:.2f}x)'.format(
+        t_eager * 1000, t_eager / t_lazy))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Unit tests for ansi.AnsiWriter."""
+
+# pylint: disable=missing-docstring
+
+import io
+import unittest
+
+from prompt_toolkit.output import ColorDepth
+from prompt_toolkit.styles import DynamicStyle, Style
+
+from pp_highlighting import AnsiWriter
+
+
+class TestAnsiWriter(unittest.TestCase):
+    def test_basic(self):
+        out = io.StringIO()
+        style = Style([('a', '#ff0000'), ('b', 'bold')])
+        with AnsiWriter(out, style=style) as writer:
+            writer.write([('class:a', 'x'), ('class:a', 'y'), ('', ' ')])
+            writer.write([('class:b', 'z')])
+        self.assertEqual(out.getvalue(),
+                         '\x1b[0;38;5;196mxy\x1b[0m \x1b[0;1mz\x1b[0m')
+
+    def test_unstyled(self):
+        out = io.StringIO()
+        with AnsiWriter(out) as writer:
+            writer.write([('', 'a\n'), ('class:unknown', 'b')])
+        self.assertEqual(out.getvalue(), 'a\nb')
+
+    def test_color_depth(self):
+        out = io.StringIO()
+        style = Style([('a', '#ff0000 bold')])
+        with AnsiWriter(out, style=style,
+                        color_depth=ColorDepth.DEPTH_1_BIT) as writer:
+            writer.write([('class:a', 'x')])
+        self.assertEqual(out.getvalue(), '\x1b[0;1mx\x1b[0m')
+
+    def test_dynamic_style(self):
+        styles = [Style([('a', 'bold')])]
+        out = io.StringIO()
+        writer = AnsiWriter(out, style=DynamicStyle(lambda: styles[0]))
+        writer.write([('class:a', 'x')])
+        styles[0] = Style([('a', 'underline')])
+        writer.write([('class:a', 'y')])
+        writer.close()
+        self.assertEqual(out.getvalue(), '\x1b[0;1mx\x1b[0;4my\x1b[0m')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""Unit tests for first_chars.first_chars_re."""
+
+# pylint: disable=missing-docstring
+
+import re
+import unittest
+
+import pyparsing as pp
+from pyparsing import pyparsing_common as ppc
+
+from pp_highlighting import Styler
+from pp_highlighting.first_chars import first_chars_re
+
+
+def starts(expr, chars):
+    first_re = first_chars_re(expr)
+    return ''.join(c for c in chars if first_re.match(c))
+
+
+class TestFirstChars(unittest.TestCase):
+    def test_literal(self):
+        self.assertEqual(starts(pp.Literal('ab'), 'abc'), 'a')
+
+    def test_caseless(self):
+        self.assertEqual(starts(pp.CaselessKeyword('nil'), 'nNiıI'), 'nN')
+        self.assertEqual(starts(pp.CaselessLiteral('is'), 'iIıs'), 'iIı')
+
+    def test_word(self):
+        self.assertEqual(starts(ppc.identifier, 'a_1 -'), 'a_')
+
+    def test_regex(self):
+        self.assertEqual(starts(ppc.fnumber, '+-1.a '), '+-1')
+        self.assertEqual(starts(pp.Regex(r'(?:ab|c)*d'), 'abcde'), 'acd')
+        self.assertEqual(starts(pp.Regex('[^a-c]'), 'abcd'), 'd')
+
+    def test_and(self):
+        expr = pp.Optional('-') + pp.Optional('+') + ppc.integer
+        self.assertEqual(starts(expr, '-+1 a'), '-+1')
+
+    def test_match_first(self):
+        expr = pp.Literal('a') | pp.QuotedString('"') | pp.Word('xy')
+        self.assertEqual(starts(expr, 'a"xyz '), 'a"xy')
+
+    def test_forward(self):
+        expr = pp.Forward()
+        expr <<= ppc.integer | pp.Suppress('(') + pp.ZeroOrMore(expr) + ')'
+        self.assertEqual(starts(expr, '(1)a'), '(1')
+
+    def test_styled(self):
+        styler = Styler()
+        expr = styler('class:int', ppc.integer) + styler('class:op', '+')
+        self.assertEqual(starts(expr, '1+a'), '1')
+
+    def test_inner_whitespace(self):
+        expr = pp.Literal('a') | pp.Literal('b').setWhitespaceChars('_')
+        self.assertEqual(starts(expr, 'ab_ '), 'ab_')
+
+    def test_any(self):
+        self.assertIsNone(first_chars_re(pp.Optional('a')))
+        self.assertIsNone(first_chars_re(~pp.Literal('a') + pp.Word('ab')))
+        self.assertIsNone(first_chars_re(pp.Regex('a', flags=re.I)))
+        self.assertIsNone(first_chars_re(pp.SkipTo('a')))
+        forward = pp.Forward()
+        forward <<= forward + 'a' | 'b'
+        self.assertIsNone(first_chars_re(forward))
+
+    def test_ignore(self):
+        expr = ppc.integer.copy().ignore(pp.pythonStyleComment)
+        self.assertIsNone(first_chars_re(expr))
+
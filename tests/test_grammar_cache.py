@@ -0,0 +1,90 @@
+"""Unit tests for grammar_cache."""
+
+# pylint: disable=missing-docstring
+
+import os
+import tempfile
+import threading
+import unittest
+
+import pyparsing as pp
+from pyparsing import pyparsing_common as ppc
+
+from pp_highlighting import PPHighlighter
+from pp_highlighting import grammar_cache
+
+try:
+    from pygments.token import Token
+    HAS_PYGMENTS = True
+except ImportError:
+    HAS_PYGMENTS = False
+
+calls = []
+
+
+def parser_factory(styler):
+    calls.append(styler)
+    scale = 10
+    number = styler('class:number', ppc.number).addParseAction(lambda t: t[0] * scale)
+    name = styler('class:name', ppc.identifier)
+    pair = pp.Group(name + pp.Suppress('=') + pp.Optional(number))
+    operand = number | name
+    expr = pp.infixNotation(operand, [(pp.oneOf('* /'), 2, pp.opAssoc.LEFT),
+                                      (pp.oneOf('+ -'), 2, pp.opAssoc.LEFT)])
+    return pp.OneOrMore(pair | expr)
+
+
+def parser_factory_pygments(styler):
+    return pp.OneOrMore(styler(Token.Number, ppc.integer))
+
+
+def parser_factory_unpicklable(styler):
+    lock = threading.Lock()
+    def action(t):
+        with lock:
+            return t
+    return styler('class:int', ppc.integer).addParseAction(action)
+
+
+class TestGrammarCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_load(self):
+        del calls[:]
+        s = 'x = 1.5 y = (a + 2) * 3'
+        pph = PPHighlighter(parser_factory, grammar_cache_dir=self.tmp.name)
+        self.assertEqual(len(os.listdir(self.tmp.name)), 1)
+        pph_cached = PPHighlighter(parser_factory, grammar_cache_dir=self.tmp.name)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(pph_cached.highlight(s), pph.highlight(s))
+        self.assertEqual(pph_cached.expr.parseString(s, parseAll=True).asList(),
+                         [['x', 15.0], ['y'], [['a', '+', 20], '*', 30]])
+
+    @unittest.skipUnless(HAS_PYGMENTS, 'Pygments not installed.')
+    def test_pygments_tokens(self):
+        PPHighlighter(parser_factory_pygments, uses_pygments_tokens=True,
+                      grammar_cache_dir=self.tmp.name)
+        pph = PPHighlighter(parser_factory_pygments, uses_pygments_tokens=True,
+                            grammar_cache_dir=self.tmp.name)
+        self.assertIs(pph.styler.styles[0], Token.Number)
+        self.assertEqual(pph.highlight_html('1'),
+                         '<pre class="highlight"><span class="m">1</span></pre>')
+
+    def test_unpicklable(self):
+        with self.assertWarns(RuntimeWarning):
+            pph = PPHighlighter(parser_factory_unpicklable,
+                                grammar_cache_dir=self.tmp.name)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+        self.assertEqual(pph.highlight('1'), [('class:int', '1')])
+
+    def test_fingerprint(self):
+        self.assertEqual(grammar_cache.fingerprint(parser_factory),
+                         grammar_cache.fingerprint(parser_factory))
+        self.assertNotEqual(grammar_cache.fingerprint(parser_factory),
+                            grammar_cache.fingerprint(parser_factory_pygments))
+
+
+if __name__ == '__main__':
+    unittest.main()
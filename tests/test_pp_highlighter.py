@@ -2,16 +2,27 @@
 
 # pylint: disable=missing-docstring, protected-access, too-many-public-methods
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import io
+import os
+import subprocess
 import sys
+import tempfile
+import time
 import unittest
 
 from prompt_toolkit import print_formatted_text
 from prompt_toolkit.document import Document
 from prompt_toolkit.formatted_text import FormattedText
+from prompt_toolkit.formatted_text.utils import split_lines
+from prompt_toolkit.lexers import SyntaxSync
+from prompt_toolkit.styles import Style
+from prompt_toolkit.validation import ValidationError
 import pyparsing as pp
 from pyparsing import pyparsing_common as ppc
 
-from pp_highlighting import PPHighlighter
+from pp_highlighting import dummy_styler, PPHighlighter, PPValidator
 
 
 def info(msg):
@@ -96,6 +107,25 @@ def parser_factory_backout(styler):
     return c
 
 
+def parser_factory_slow(styler):
+    def slow():
+        time.sleep(0.01)
+    a = styler('class:int', ppc.integer)
+    a.addParseAction(slow)
+    return pp.OneOrMore(a)
+
+
+def parser_factory_slow_items(styler):
+    def slow():
+        time.sleep(0.01)
+    return styler('class:int', ppc.integer).addParseAction(slow)
+
+
+def parser_factory_statements(styler):
+    statement = pp.Group(styler('class:int', ppc.integer) + ';')
+    return pp.OneOrMore(statement | styler('class:word', ppc.identifier))
+
+
 def parser_factory_exception(styler):
     def exception():
         raise RuntimeError('test')
@@ -135,6 +165,31 @@ def parser_factory_set_parse_action(styler):
     return c
 
 
+def parser_factory_backtrack(styler):
+    name = styler('class:name', ppc.identifier)
+    call = name + styler('class:paren', '(') + styler('class:int', ppc.integer)
+    return name + '=' + ppc.integer | call + ')' | call + ',' + name + ')'
+
+
+def parser_factory_lookahead(styler):
+    a = styler('class:a', 'x') + pp.FollowedBy(pp.Regex('[^!]*!'))
+    return a | styler('class:b', 'x')
+
+
+def parser_factory_packrat(styler):
+    group = pp.Group(styler('class:a', 'a'))
+    return group + 'x' | group + 'y'
+
+
+def parser_factory_rollback(styler):
+    a = styler('class:a', 'a')
+    b = styler('class:b', 'b')
+    partial = a + 'c' + b + 'x' | 'a' + pp.Word('cb')
+    trial = (a + 'd' + b) ^ ('a' + pp.Word('dbe'))
+    lookahead = 'f' + pp.FollowedBy(a)
+    return partial | trial | lookahead
+
+
 class TestPPHighlighter(unittest.TestCase):
     def test_class(self):
         pph = PPHighlighter(parser_factory)
@@ -265,6 +320,104 @@ class TestPPHighlighter(unittest.TestCase):
         with self.assertRaises(IndexError):
             lines(2)
 
+    def test_document_lexer_incremental(self):
+        pph = PPHighlighter(parser_factory, incremental=True)
+        pph_full = PPHighlighter(parser_factory)
+        texts = ['(1 2)\n(3 4)', '(1 2)\n(3.5 4)', '(1 a2)\n(3.5 4)',
+                 '(1 a2)\n(3.5 4', '5 (1 a2)\n(3.5 4', '']
+        for s in texts:
+            lines = pph.lex_document(Document(s))
+            lines_full = pph_full.lex_document(Document(s))
+            for i in range(s.count('\n') + 1):
+                self.assertEqual(lines(i), lines_full(i))
+
+    def test_document_lexer_incremental_reuse(self):
+        pph = PPHighlighter(parser_factory, incremental=True)
+        pph.lex_document(Document('(1) (2) (3)'))
+        _, _, checkpoints, _, complete = pph._lex_state
+        self.assertTrue(complete)
+        self.assertEqual(checkpoints, [0, 3, 7, 11])
+        lines = pph.lex_document(Document('(1) (22) (3)'))
+        self.assertEqual(lines(0), [('', '('), ('class:int', '1'), ('', ') ('),
+                                    ('class:int', '22'), ('', ') ('),
+                                    ('class:int', '3'), ('', ')')])
+        _, spans, checkpoints, _, _ = pph._lex_state
+        self.assertEqual(checkpoints, [0, 3, 8, 12])
+        self.assertEqual(list(spans.data[0::3]), [1, 5, 10])
+
+    def test_document_lexer_incremental_lookahead(self):
+        pph = PPHighlighter(parser_factory_lookahead, incremental=True)
+        pph_full = PPHighlighter(parser_factory_lookahead)
+        for s in ['x x x x !', 'x x x x ', 'x x! x x ']:
+            lines = pph.lex_document(Document(s))
+            self.assertEqual(lines(0), pph_full.lex_document(Document(s))(0))
+        self.assertEqual(pph._lex_state[3][1], float('inf'))
+        pph = PPHighlighter(parser_factory_abc, incremental=True)
+        pph.lex_document(Document('abc'))
+        self.assertEqual(pph._lex_state[3], [0, 4])
+
+    def test_document_lexer_lazy(self):
+        pph = PPHighlighter(parser_factory, lazy=True)
+        pph_full = PPHighlighter(parser_factory)
+        document = Document('(1 2\n 3.5) x\n(4\n\n5 (6)) (7')
+        lines = pph.lex_document(document)
+        lines_full = pph_full.lex_document(document)
+        for i in [3, 0, 4, 1, 2]:
+            self.assertEqual(lines(i), lines_full(i))
+        with self.assertRaises(IndexError):
+            lines(5)
+
+    def test_document_lexer_lazy_syntax_sync(self):
+        class LineSync(SyntaxSync):
+            def __init__(self):
+                self.linenos = []
+
+            def get_sync_start_position(self, document, lineno):
+                self.linenos.append(lineno)
+                return lineno, 0
+
+        sync = LineSync()
+        pph = PPHighlighter(parser_factory, lazy=True, syntax_sync=sync)
+        pph.MIN_LINES_BACKWARDS = 0
+        lines = pph.lex_document(Document('(1\n(2 3\n4)\n5'))
+        self.assertEqual(lines(2), [('class:int', '4'), ('', ')')])
+        self.assertEqual(lines(3), [('', ''), ('class:int', '5')])
+        self.assertEqual(sync.linenos, [2])
+
+    def test_cache(self):
+        pph = PPHighlighter(parser_factory, cache_size=2)
+        fragments = pph.highlight('(1)')
+        fragments.append(('', 'x'))
+        self.assertEqual(pph.highlight('(1)'), [('', '('), ('class:int', '1'), ('', ')')])
+        self.assertEqual(pph.highlight_html('(1)'), pph.highlight_html('(1)'))
+        self.assertNotEqual(pph.highlight_html('(1)', css_class='hl'),
+                            pph.highlight_html('(1)'))
+        self.assertEqual(pph.cache_info(), (3, 3, 2, 2))
+        pph.highlight('(2)')
+        pph.highlight('(1)')
+        self.assertEqual(pph.cache_info(), (3, 5, 2, 2))
+        pph.cache_clear()
+        self.assertEqual(pph.cache_info(), (0, 0, 2, 0))
+
+    def test_cache_disabled(self):
+        pph = PPHighlighter(parser_factory)
+        pph.highlight('(1)')
+        pph.highlight('(1)')
+        self.assertEqual(pph.cache_info(), (0, 0, 0, 0))
+
+    @unittest.skipUnless(HAS_PYGMENTS, 'Pygments not installed.')
+    def test_cache_pygments(self):
+        pph = PPHighlighter(parser_factory_pygments, uses_pygments_tokens=True,
+                            cache_size=4)
+        expected = [('class:pygments.text', '('),
+                    ('class:pygments.literal.number.integer', '1'),
+                    ('class:pygments.text', ')')]
+        self.assertEqual(pph.highlight('(1)'), expected)
+        self.assertEqual(pph.highlight('(1)'), expected)
+        expected = '<pre class="highlight">(<span class="mi">1</span>)</pre>'
+        self.assertEqual(pph.highlight_html('(1)'), expected)
+        self.assertEqual(pph.highlight_html('(1)'), expected)
+
     def test_restart(self):
         pph = PPHighlighter(parser_factory)
         fragments = pph.highlight('(1 (a 2))')
@@ -275,12 +428,453 @@ class TestPPHighlighter(unittest.TestCase):
                     ('', '))')]
         self.assertEqual(fragments, expected)
 
+    def test_first_chars(self):
+        pph = PPHighlighter(parser_factory)
+        self.assertIsNotNone(pph._first_re)
+        s = 'a(1 b (2.5 c)) d 3 \t\n e'
+        fragments = pph.highlight(s)
+        pph._first_re = None
+        self.assertEqual(fragments, pph.highlight(s))
+
+    def test_sync_points(self):
+        pph = PPHighlighter(parser_factory, sync_points='\n')
+        fragments = pph.highlight('1 a 2\n3')
+        expected = [('class:int', '1'),
+                    ('', ' a 2\n'),
+                    ('class:int', '3')]
+        self.assertEqual(fragments, expected)
+        with self.assertRaises(ValueError):
+            PPHighlighter(parser_factory, sync_points='')
+
+    def test_sync_points_expr(self):
+        pph = PPHighlighter(parser_factory, sync_points=pp.Literal('))'))
+        fragments = pph.highlight('(a 1) 2)) 3')
+        expected = [('', '(a 1) 2)) '), ('class:int', '3')]
+        self.assertEqual(fragments, expected)
+
+    def test_sync_points_incremental(self):
+        pph = PPHighlighter(parser_factory, incremental=True, sync_points='\n')
+        pph.lex_document(Document('1 a\n2 b\n3'))
+        self.assertEqual(pph._lex_state[2], [0, 1, 4, 5, 8, 9])
+        lines = pph.lex_document(Document('1 a\n2 b\n34'))
+        self.assertEqual(lines(2), [('', ''), ('class:int', '34')])
+
+    def test_memo(self):
+        s = 'f(1, x) y=2 g(3'
+        fragments = PPHighlighter(parser_factory_backtrack).highlight(s)
+        pph = PPHighlighter(parser_factory_backtrack, memo_size=100)
+        self.assertEqual(pph.highlight(s), fragments)
+        self.assertGreater(pph.styler.memo.cache.hits, 0)
+        self.assertEqual(pph.highlight(s), fragments)
+
+    def test_memo_evict(self):
+        s = 'f(1, x) y=2 g(3'
+        fragments = PPHighlighter(parser_factory_backtrack).highlight(s)
+        pph = PPHighlighter(parser_factory_backtrack, memo_size=2)
+        self.assertEqual(pph.highlight(s), fragments)
+        self.assertEqual(len(pph.styler.memo.cache), 2)
+
+    def test_memo_subtrees(self):
+        calls = []
+
+        def parser_factory_counted(styler):
+            group = pp.Group(styler('class:a', 'a'))
+            group.addParseAction(lambda: calls.append(None))
+            return group + 'x' | group + 'y'
+
+        pph = PPHighlighter(parser_factory_counted, memo_size=100)
+        self.assertEqual(pph.highlight('a y'), [('class:a', 'a'), ('', ' y')])
+        self.assertEqual(len(calls), 1)
+
+    def test_threads(self):
+        pph = PPHighlighter(parser_factory_backtrack, memo_size=100)
+        strings = ['f(1, x) y=2 g(3', 'a=1 b(2) c(3, d)'] * 4
+        expected = [pph.highlight(s) for s in strings]
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(pph.highlight, strings * 10))
+        self.assertEqual(results, expected * 10)
+
+    def test_shared_parser(self):
+        pph = PPHighlighter(parser_factory_rollback)
+        parser = parser_factory_rollback(dummy_styler)
+        fragments = pph.highlight('acb adb fa')
+        for s in ['acbx', 'acb', 'adb', 'adbe']:
+            self.assertEqual(pph.expr.parseString(s, parseAll=True).asList(),
+                             parser.parseString(s, parseAll=True).asList())
+        self.assertEqual(len(pph.styler.spans), 0)
+        with self.assertRaises(ValidationError):
+            PPValidator(pph.expr).validate(Document('fa'))
+        self.assertEqual(pph.highlight('acb adb fa'), fragments)
+        styled = pph.styler('class:int', pp.Word(pp.nums))
+        self.assertEqual(str(styled), str(pp.Word(pp.nums)))
+        self.assertEqual(str(styled.setName('integer')), 'integer')
+
+    def test_parse_error(self):
+        for incremental in [False, True]:
+            pph = PPHighlighter(parser_factory, incremental=incremental)
+            for s in ['(1 (2.5))', '(1 (2.5)) 3', '(1 (2.5', 'x(1)', '', '1 x']:
+                try:
+                    pph.expr.parseString(s, parseAll=True)
+                except pp.ParseBaseException as err:
+                    error = err
+                else:
+                    error = None
+                self.assertEqual(repr(pph.parse_error(s)), repr(error))
+        pph = PPHighlighter(parser_factory_exception)
+        with self.assertWarns(RuntimeWarning):
+            self.assertEqual(repr(pph.parse_error('(1)')), repr(RuntimeError('test')))
+
+    def test_lazy_imports(self):
+        code = ('import sys; import pyparsing as pp; import pp_highlighting; '
+                'pph = pp_highlighting.PPHighlighter(lambda s: s("class:a", "a")); '
+                'pph.highlight_html("a"); '
+                'print(sorted({"asyncio", "prompt_toolkit", "pygments"} & set(sys.modules)))')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        out = subprocess.run([sys.executable, '-c', code], cwd=root, check=True,
+                             stdout=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(out.stdout.strip(), '[]')
+
+    def test_lexer_subclass(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        for imports in ['import pp_highlighting; import prompt_toolkit',
+                        'import prompt_toolkit; import pp_highlighting']:
+            code = (imports + '; from prompt_toolkit.lexers import Lexer; '
+                    'pph = pp_highlighting.PPHighlighter(lambda s: s("class:a", "a")); '
+                    'print(issubclass(pp_highlighting.PPHighlighter, Lexer), '
+                    'isinstance(pph, Lexer))')
+            out = subprocess.run([sys.executable, '-c', code], cwd=root, check=True,
+                                 stdout=subprocess.PIPE, universal_newlines=True)
+            self.assertEqual(out.stdout.strip(), 'True True')
+
+    def test_highlight_spans(self):
+        pph = PPHighlighter(parser_factory)
+        spans = pph.highlight_spans('(1 2.5) x')
+        self.assertEqual(list(spans), [(1, 2, 'class:int'),
+                                       (3, 6, 'class:float')])
+        self.assertEqual(spans.fragments(), pph.highlight('(1 2.5) x'))
+
+    def test_budget(self):
+        pph = PPHighlighter(parser_factory_slow, cache_size=1)
+        s = ' '.join(['1'] * 20)
+        spans = pph.highlight_spans(s, budget=0.03)
+        self.assertGreater(spans.stopped_at, 0)
+        self.assertLess(len(spans), 10)
+        self.assertEqual(spans.ends[-1], spans.stopped_at)
+        fragments = pph.highlight(s, budget=0.03)
+        self.assertEqual(fragments[-1][0], '')
+        self.assertGreater(fragments.stopped_at, 0)
+        self.assertLess(fragments.stopped_at, len(s))
+        self.assertEqual(''.join(text for _, text in fragments), s)
+        self.assertEqual(len(pph.cache_info()), 4)
+        self.assertEqual(pph.cache_info().currsize, 0)
+        self.assertIsNone(pph.highlight_spans(s).stopped_at)
+        self.assertIsNone(pph.highlight(s).stopped_at)
+
+    def test_budget_lexer(self):
+        pph = PPHighlighter(parser_factory_slow, budget=0.03)
+        document = Document(' '.join(['1'] * 20))
+        lines = pph.lex_document(document)
+        self.assertEqual(lines(0)[-1][0], '')
+        hash_ = pph.invalidation_hash()
+        for _ in range(100):
+            if pph.invalidation_hash() != hash_:
+                break
+            time.sleep(0.05)
+        lines = pph.lex_document(document)
+        self.assertEqual(lines(0)[-1], ('class:int', '1'))
+
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        return loop.run_until_complete(coro)
+
+    def test_highlight_async(self):
+        pph = PPHighlighter(parser_factory_slow)
+        s = ' '.join(['1'] * 10)
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(None)
+                await asyncio.sleep(0.005)
+
+        async def highlight():
+            task = asyncio.ensure_future(tick())
+            try:
+                return await pph.highlight_async(s)
+            finally:
+                task.cancel()
+
+        # The whole string is one match, which is never interrupted
+        self.assertEqual(self.run_async(highlight()), pph.highlight(s))
+        self.assertGreater(len(ticks), 5)
+        fragments = self.run_async(pph.highlight_async(s, budget=0.03))
+        self.assertLess(fragments.stopped_at, len(s))
+
+    def test_highlight_async_cache(self):
+        pph = PPHighlighter(parser_factory, cache_size=1)
+        for _ in range(2):
+            self.assertEqual(self.run_async(pph.highlight_async('(1 2)')),
+                             pph.highlight('(1 2)'))
+        self.assertEqual(pph.cache_info()[:2], (3, 1))
+        with self.assertRaises(TypeError):
+            self.run_async(pph.highlight_async(b'(1 2)'))
+
+    def test_budget_lexer_progress(self):
+        pph = PPHighlighter(parser_factory_slow_items, budget=0.02, progress_interval=0.05,
+                            incremental=True)
+        document = Document(' '.join(['1'] * 30))
+        lines = pph.lex_document(document)
+        self.assertEqual(lines(0)[-1][0], '')
+        partial = []
+        for _ in range(100):
+            line = pph.lex_document(document)(0)
+            if line[-1][0]:
+                break
+            partial.append(line)
+            time.sleep(0.01)
+        self.assertGreater(len(partial[-1]), len(lines(0)))
+        self.assertEqual(pph.lex_document(document)(0), pph.highlight(document.text))
+        self.assertEqual(pph._lex_state[0], document.text)
+
+    def test_budget_lexer_typing(self):
+        pph = PPHighlighter(parser_factory_slow_items, budget=0.05, incremental=True)
+        s = ' '.join(['1'] * 40)
+        styled = []
+        for _ in range(12):
+            s = s[:2] + '2' + s[2:]
+            line = pph.lex_document(Document(s))(0)
+            styled.append(sum(len(text) for style, text in line if style))
+        self.assertGreater(min(styled), 0)
+        self.assertGreater(styled[-1], styled[0])
+        for _ in range(100):
+            if pph._shared.get(s) is not None:
+                break
+            time.sleep(0.05)
+        self.assertEqual(pph.lex_document(Document(s))(0), pph.highlight(s))
+        self.assertTrue(pph._lex_state[4])
+
+    def test_budget_lexer_fallback(self):
+        for incremental in [False, True]:
+            pph = PPHighlighter(parser_factory_slow_items, incremental=incremental)
+            pph.lex_document(Document('1 2 3'))
+            pph.budget = 0
+            self.assertEqual(pph.lex_document(Document('x1 2 3'))(0),
+                             [('', 'x')] + pph.highlight('1 2 3'))
+            for _ in range(100):
+                if pph._shared.get('x1 2 3') is not None:
+                    break
+                time.sleep(0.01)
+            with pph._shared_lock:
+                self.assertEqual(pph.lex_document(Document('x1 2 3 4'))(0),
+                                 pph.highlight('x1 2 3') + [('', ' 4')])
+
+    def test_budget_lexer_superseded(self):
+        pph = PPHighlighter(parser_factory_slow, budget=0.01)
+        stale = Document(' '.join(['1'] * 500))
+        pph.lex_document(stale)
+        time.sleep(0.05)
+        pph.lex_document(stale)
+        document = Document('1 1')
+        start = time.monotonic()
+        pph.lex_document(document)
+        for _ in range(100):
+            if pph._shared.get(document.text) is not None:
+                break
+            time.sleep(0.01)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(pph.lex_document(document)(0)[-1], ('class:int', '1'))
+        self.assertIsNone(pph._shared.get(stale.text))
+
+    def test_profile(self):
+        pph = PPHighlighter(parser_factory_statements, profile=True)
+        pph.highlight('1; 2 a ;')
+        report = pph.profile_report(sort_by='attempts')
+        self.assertEqual([entry[1:5] for entry in report],
+                         [('class:int', 5, 3, 2), ('class:word', 4, 1, 0)])
+        for entry in report:
+            self.assertGreater(entry.self_time, 0)
+            self.assertLessEqual(entry.self_time, entry.total_time)
+        out = io.StringIO()
+        pph.print_profile(file=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 3)
+        pph.profile_clear()
+        self.assertEqual(pph.profile_report()[0].attempts, 0)
+        with self.assertRaises(ValueError):
+            pph.profile_report(sort_by='style')
+        self.assertEqual(PPHighlighter(parser_factory).profile_report(), [])
+
+    def test_observer(self):
+        calls = []
+        pph = PPHighlighter(parser_factory, cache_size=4, observer=calls.append)
+        for _ in range(2):
+            pph.highlight('(1 (a 2))')
+            pph.highlight_html('(1 (a 2))')
+        pph.lex_document(Document('(1 (a 2))\n3'))
+        self.assertEqual([call[:4] + call[5:] for call in calls],
+                         [('highlight', 9, 5, 2, False),
+                          ('highlight_html', 9, 5, 2, False),
+                          ('highlight', 9, 5, None, True),
+                          ('highlight_html', 9, None, None, True),
+                          ('lex_document', 11, 6, 2, False)])
+        for call in calls:
+            self.assertGreater(call.time, 0)
+
+    def test_observer_exception(self):
+        def observer(stats):
+            raise RuntimeError('test')
+        pph = PPHighlighter(parser_factory, observer=observer)
+        with self.assertWarns(RuntimeWarning):
+            self.assertEqual(pph.highlight('1'), [('class:int', '1')])
+
+    def test_profile_copies(self):
+        pph = PPHighlighter(parser_factory_slow_items, profile=True)
+        copy = pph.expr.copy().setParseAction(lambda t: t[0] * 2)
+        with pph.styler.capture():
+            self.assertEqual(copy.parseString('2').asList(), [4])
+        report = pph.styler.profile()
+        self.assertEqual([(entry.element, entry.attempts) for entry in report],
+                         [(pph.expr, 0), (copy, 1)])
+
+    def test_highlight_many(self):
+        pph = PPHighlighter(parser_factory)
+        strings = ['(1 2)', '3.5', 'a (4)']
+        expected = [pph.highlight(s) for s in strings]
+        self.assertEqual(pph.highlight_many(iter(strings)), expected)
+        expected = [pph.highlight_html(s) for s in strings]
+        self.assertEqual(pph.highlight_html_many(strings), expected)
+
+    def test_highlight_many_parallel(self):
+        pph = PPHighlighter(parser_factory)
+        pph.MIN_PARALLEL_CHARS = 0
+        strings = ['(1 2)', '3.5', 'a (4)'] * 5
+        expected = [pph.highlight(s) for s in strings]
+        fragments = pph.highlight_many(strings, chunksize=4, max_workers=2)
+        self.assertEqual(fragments, expected)
+        self.assertTrue(isinstance(fragments[0], FormattedText))
+        expected = [pph.highlight_html(s, css_class='x') for s in strings]
+        html = pph.highlight_html_many(strings, css_class='x', chunksize=4,
+                                       max_workers=2)
+        self.assertEqual(html, expected)
+
+    def test_highlight_stream(self):
+        pph = PPHighlighter(parser_factory)
+        s = '(1 2)\n3.5 a\n\n(4'
+        expected = []
+        for line in s.splitlines(True):
+            expected += pph.highlight(line)
+        def lines(fragments):
+            return [[f for f in line if f[1]] for line in split_lines(fragments)]
+        expected = lines(expected)
+        for chunks in [[s], list(s), ['(1 ', '2)\n3', '.5 a\n', '\n(4']]:
+            fragments = list(pph.highlight_stream(iter(chunks)))
+            self.assertEqual(''.join(text for _, text in fragments), s)
+            self.assertEqual(lines(fragments), expected)
+
+    def test_highlight_stream_boundary(self):
+        pph = PPHighlighter(parser_factory)
+        chunks = ['a\r', '\n(1)\r', '\n']
+        fragments = list(pph.highlight_stream(chunks, boundary='\r\n'))
+        expected = [('', 'a\r\n('), ('class:int', '1'), ('', ')\r\n')]
+        self.assertEqual(fragments, expected)
+        with self.assertRaises(ValueError):
+            list(pph.highlight_stream(chunks, boundary=''))
+
+    def test_highlight_ansi(self):
+        pph = PPHighlighter(parser_factory)
+        style = Style([('int', 'bold'), ('float', 'underline')])
+        ansi = pph.highlight_ansi('(1 2.5)', style=style)
+        self.assertEqual(ansi, '(\x1b[0;1m1\x1b[0m \x1b[0;4m2.5\x1b[0m)')
+
+    def test_highlight_file(self):
+        pph = PPHighlighter(parser_factory)
+        s = '(1 2)\n3.5 é\n\n(4'
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'input.txt')
+            with open(path, 'w', encoding='utf-8', newline='') as f:
+                f.write(s)
+            for chunk_size in [1, 3, 2**16]:
+                out = io.StringIO()
+                pph.highlight_file(path, out, css_class='x',
+                                   chunk_size=chunk_size)
+                self.assertEqual(out.getvalue(),
+                                 pph.highlight_html(s, css_class='x'))
+            out = io.StringIO()
+            style = Style([('int', 'bold')])
+            pph.highlight_file(path, out, format='ansi', style=style)
+            self.assertEqual(out.getvalue(), pph.highlight_ansi(s, style=style))
+            with self.assertRaises(ValueError):
+                pph.highlight_file(path, out, format='rtf')
+
     def test_backout(self):
         pph = PPHighlighter(parser_factory_backout)
         fragments = pph.highlight('(1)')
         expected = [('', '(1)')]
         self.assertEqual(fragments, expected)
 
+    def test_rollback(self):
+        pph = PPHighlighter(parser_factory_rollback)
+        for s in ['acb', 'adbe', 'fa', 'acbx']:
+            fragments = pph.highlight(s)
+            if s == 'acbx':
+                expected = [('class:a', 'a'), ('', 'c'), ('class:b', 'b'),
+                            ('', 'x')]
+            else:
+                expected = [('', s)]
+            self.assertEqual(fragments, expected)
+
+    def enable_packrat(self):
+        pp.ParserElement.enablePackrat()
+
+        def disable():
+            pp.ParserElement._packratEnabled = False
+            pp.ParserElement._parse = pp.ParserElement._parseNoCache
+        self.addCleanup(disable)
+
+    def test_rollback_packrat(self):
+        pph_before = PPHighlighter(parser_factory_packrat)
+        self.enable_packrat()
+        expected = [('class:a', 'a'), ('', ' y')]
+        for pph in [pph_before, PPHighlighter(parser_factory_packrat)]:
+            self.assertEqual(pph.highlight('a y'), expected)
+            self.assertEqual(pph.expr.parseString('a y').asList(), [['a'], 'y'])
+            self.assertEqual(pph.highlight('a y'), expected)
+
+    def test_packrat_isolation(self):
+        self.enable_packrat()
+        pph = PPHighlighter(parser_factory_packrat)
+        calls = []
+
+        def count():
+            calls.append(None)
+
+        def highlight():
+            self.assertEqual(pph.highlight('a y'), [('class:a', 'a'), ('', ' y')])
+
+        # The second alternative's word comes from the packrat cache, which
+        # highlighting in between must not reset
+        word = pp.Word(pp.alphas).addParseAction(count)
+        other = word + pp.Empty().addParseAction(highlight) + '1' | word + '2'
+        other.parseString('ab 2')
+        self.assertEqual(len(calls), 1)
+
+    def test_rollback_copies(self):
+        pph = PPHighlighter(parser_factory_rollback, profile=True)
+        expr = pph.expr
+        self.assertEqual(expr('all').parseString('acbx').asDict(),
+                         {'all': ['a', 'c', 'b', 'x']})
+        tagged = expr.copy().setParseAction(lambda t: ['tagged'])
+        self.assertEqual(tagged.parseString('acbx').asList(), ['tagged'])
+        partial, trial = expr.exprs[0], expr.exprs[2]
+        partial = partial.copy().addParseAction(len)
+        self.assertEqual(partial.parseString('acbx').asList(), [4])
+        trial = trial('trial')
+        self.assertEqual(trial.parseString('adb')['trial'].asList(), ['a', 'd', 'b'])
+        styled = expr.exprs[0].exprs[0]('a')
+        self.assertEqual(styled.parseString('a')['a'], 'a')
+        self.assertEqual(pph.highlight('acbx'),
+                         [('class:a', 'a'), ('', 'c'), ('class:b', 'b'), ('', 'x')])
+
     def test_warning(self):
         pph = PPHighlighter(parser_factory_exception)
         with self.assertWarns(RuntimeWarning):
@@ -2,13 +2,16 @@
 
 # pylint: disable=missing-docstring
 
+import asyncio
+import threading
+import time
 import unittest
 
 from prompt_toolkit.document import Document
 from prompt_toolkit.validation import ValidationError
 import pyparsing as pp
 
-from pp_highlighting import PPValidator
+from pp_highlighting import PPHighlighter, PPValidator
 
 def exception():
     raise RuntimeError('test')
@@ -16,6 +19,26 @@ def exception():
 parser = pp.OneOrMore(pp.Literal('test'))
 parser_exception = parser.copy().addParseAction(exception)
 
+parsed = []
+statement = pp.Word(pp.alphas) + pp.Suppress(';')
+statement.addParseAction(lambda t: parsed.append(t[0]))
+parser_statements = pp.ZeroOrMore(statement)
+
+started = threading.Event()
+
+def slow(t):
+    parsed.append(t[0])
+    started.set()
+    time.sleep(0.05)
+
+def parser_factory(styler):
+    return pp.OneOrMore(styler('class:word', statement))
+
+def parser_factory_statement(styler):
+    return styler('class:word', statement)
+
+parser_slow = pp.OneOrMore(pp.Word(pp.alphas).addParseAction(slow))
+
 
 class TestPPValidator(unittest.TestCase):
     def test_succeed(self):  # pylint: disable=no-self-use
@@ -74,6 +97,115 @@ class TestPPValidator(unittest.TestCase):
         else:
             self.fail()
 
+    def test_cache(self):
+        ppv = PPValidator(parser_statements, cache_size=1)
+        del parsed[:]
+        ppv.validate(Document('a; b;'))
+        ppv.validate(Document('a; b;', 1))
+        self.assertEqual(parsed, ['a', 'b'])
+        for _ in range(2):
+            with self.assertRaises(ValidationError):
+                ppv.validate(Document('a; b'))
+        self.assertEqual(parsed, ['a', 'b', 'a'])
+
+    def test_observer(self):
+        calls = []
+        ppv = PPValidator(parser_statements, cache_size=1, observer=calls.append)
+        ppv.validate(Document('a; b;'))
+        ppv.validate(Document('a; b;', 1))
+        with self.assertRaises(ValidationError):
+            ppv.validate(Document('a; b'))
+        self.assertEqual([call[:4] + call[5:] for call in calls],
+                         [('validate', 5, None, None, False),
+                          ('validate', 5, None, None, True),
+                          ('validate', 4, None, None, False)])
+        calls = []
+        PPValidator(parser_statements, observer=calls.append).validate(Document('a;'))
+        self.assertIsNone(calls[0].cache_hit)
+
+    def test_incremental(self):
+        ppv = PPValidator(parser_statements, incremental=True)
+        del parsed[:]
+        ppv.validate(Document('a; b; c;'))
+        ppv.validate(Document('a; b; c; d;'))
+        self.assertEqual(parsed, ['a', 'b', 'c', 'c', 'd'])
+        try:
+            ppv.validate(Document('a; b; c; d; e'))
+        except ValidationError as err:
+            self.assertEqual(err.cursor_position, 12)
+        else:
+            self.fail()
+        ppv.validate(Document('a; x; c; d;'))
+        self.assertEqual(parsed[-4:], ['a', 'x', 'c', 'd'])
+
+    def test_highlighter(self):
+        pph = PPHighlighter(parser_factory)
+        ppv = PPValidator(pph)
+        del parsed[:]
+        lines = pph.lex_document(Document('a; b'))
+        try:
+            ppv.validate(Document('a; b'))
+        except ValidationError as err:
+            self.assertEqual(err.cursor_position, 3)
+        else:
+            self.fail()
+        self.assertEqual(parsed, ['a'])
+        self.assertEqual(lines(0), [('class:word', 'a;'), ('', ' b')])
+        ppv.validate(Document('a; b;'))
+        pph.lex_document(Document('a; b;'))
+        self.assertEqual(parsed, ['a', 'a', 'b'])
+
+    def test_highlighter_incremental(self):
+        pph = PPHighlighter(parser_factory_statement, incremental=True)
+        ppv = PPValidator(pph)
+        pph.lex_document(Document('a; b; c;'))
+        del parsed[:]
+        pph.lex_document(Document('a; b; c; d'))
+        self.assertEqual(parsed, ['b', 'c'])
+        with self.assertRaises(ValidationError):
+            ppv.validate(Document('a; b; c; d'))
+        self.assertEqual(parsed, ['b', 'c', 'a'])
+
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        return loop.run_until_complete(coro)
+
+    def test_validate_async(self):
+        ppv = PPValidator(parser)
+        self.run_async(ppv.validate_async(Document('test')))
+        with self.assertRaises(ValidationError):
+            self.run_async(ppv.validate_async(Document('fail')))
+
+    def test_validate_async_debounce(self):
+        ppv = PPValidator(parser_statements, debounce=0.01)
+        del parsed[:]
+        async def edit():
+            old = asyncio.ensure_future(ppv.validate_async(Document('a; b')))
+            await asyncio.sleep(0)
+            with self.assertRaises(ValidationError):
+                await ppv.validate_async(Document('a; c'))
+            await old
+        self.run_async(edit())
+        self.assertEqual(parsed, ['a'])
+
+    def test_validate_async_superseded(self):
+        ppv = PPValidator(parser_slow)
+        del parsed[:]
+        started.clear()
+        async def edit():
+            old = asyncio.ensure_future(ppv.validate_async(Document('a 1')))
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, started.wait)
+            new = asyncio.ensure_future(ppv.validate_async(Document('b')))
+            newer = asyncio.ensure_future(ppv.validate_async(Document('c 1')))
+            await old
+            await new
+            with self.assertRaises(ValidationError):
+                await newer
+        self.run_async(edit())
+        self.assertEqual(parsed, ['a', 'c'])
+
 
 if __name__ == '__main__':
     unittest.main()
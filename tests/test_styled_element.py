@@ -6,32 +6,44 @@ import unittest
 
 import pyparsing as pp
 
+from pp_highlighting import Styler
 from pp_highlighting.pp_highlighter import StyledElement
 
 
 class TestStyledElement(unittest.TestCase):
     def test_basic(self):
-        fragments = {}
+        styler = Styler()
         expr = pp.Literal('abc')
-        s_expr = StyledElement(fragments, 'class:abc', expr)
+        s_expr = StyledElement(styler, 'class:abc', expr)
         s_expr.parseString('abc', parseAll=True)
-        self.assertEqual(list(fragments), [0])
-        self.assertEqual(fragments[0], ('class:abc', 'abc'))
+        self.assertEqual(list(styler.fragments), [0])
+        self.assertEqual(styler.fragments[0], ('class:abc', 'abc'))
 
     def test_str(self):
         expr = pp.Literal('abc')
-        s_expr = StyledElement({}, 'class:abc', expr)
+        s_expr = StyledElement(Styler(), 'class:abc', expr)
         self.assertEqual(str(expr), str(s_expr))
 
     def test_does_parse_actions(self):
-        fragments = {}
+        styler = Styler()
         expr = pp.Word(pp.nums).addParseAction(lambda t: int(t[0]))
         expr.addParseAction(lambda t: t[0] * 2)
-        s_expr = StyledElement(fragments, 'class:abc', expr)
+        s_expr = StyledElement(styler, 'class:abc', expr)
         result = s_expr.parseString('123', parseAll=True)[0]
-        self.assertEqual(fragments[0], ('class:abc', '123'))
+        self.assertEqual(styler.fragments[0], ('class:abc', '123'))
         self.assertEqual(result, 246)
 
+    def test_not_capturing(self):
+        styler = Styler(always_capture=False)
+        expr = pp.Word(pp.nums).setParseAction(lambda t: int(t[0]))
+        s_expr = StyledElement(styler, 'class:abc', expr)
+        self.assertEqual(s_expr.parseString(' 123', parseAll=True)[0], 123)
+        s_expr.addParseAction(lambda t: t[0] * 2)
+        self.assertEqual(s_expr.parseString('123', parseAll=True)[0], 246)
+        self.assertEqual(styler.fragments, {})
+        with self.assertRaises(pp.ParseException):
+            s_expr.parseString('abc')
+
 
 if __name__ == '__main__':
     unittest.main()
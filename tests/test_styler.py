@@ -2,6 +2,7 @@
 
 # pylint: disable=missing-docstring
 
+import threading
 import unittest
 
 import pyparsing as pp
@@ -52,6 +53,70 @@ class TestStyler(unittest.TestCase):
         self.assertEqual(styler.get(0), ('class:int', '123'))
         self.assertEqual(styler.get(4), ('class:int', '456'))
 
+    def test_locs_many(self):
+        styler = Styler()
+        parser = pp.OneOrMore(styler('class:int', ppc.integer))
+        parser.parseString(' '.join(['1'] * 5000), parseAll=True)
+        locs = styler.locs()
+        self.assertEqual(len(locs), 5000)
+        self.assertEqual([styler.get(loc) for loc in locs], [('class:int', '1')] * 5000)
+        styler.delete(0)
+        self.assertEqual(styler.locs()[0], 2)
+        self.assertIsNone(styler.get(0))
+        styler.spans.truncate(3)
+        self.assertEqual(styler.locs(), [0])
+        self.assertEqual(styler.get(0), ('class:int', '1'))
+
+    def test_capture(self):
+        styler = Styler()
+        integer = styler('class:int', ppc.integer)
+        integer.parseString('1', parseAll=True)
+        with styler.capture() as spans:
+            integer.parseString(' 23', parseAll=True)
+            with styler.capture():
+                integer.parseString('456', parseAll=True)
+                self.assertEqual(styler.fragments, {0: ('class:int', '456')})
+            self.assertEqual(styler.locs(), [1])
+        self.assertEqual(styler.get(0), ('class:int', '1'))
+        with styler.capture(spans):
+            self.assertEqual(styler.fragments, {1: ('class:int', '23')})
+
+    def test_threads(self):
+        styler = Styler()
+        integer = styler('class:int', ppc.integer)
+        integer.parseString('1', parseAll=True)
+        thread = threading.Thread(target=integer.parseString, args=(' 2',))
+        thread.start()
+        thread.join()
+        self.assertEqual(styler.locs(), [0])
+
+    def test_always_capture_false(self):
+        styler = Styler(always_capture=False)
+        integer = styler('class:int', ppc.integer)
+        self.assertEqual(integer.parseString('1', parseAll=True)[0], 1)
+        self.assertFalse(styler.capturing)
+        self.assertEqual(styler.locs(), [])
+        with styler.capture():
+            self.assertTrue(styler.capturing)
+            integer.parseString(' 23', parseAll=True)
+            self.assertEqual(styler.locs(), [1])
+
+    def test_style_id(self):
+        styler = Styler()
+        a = styler('class:a', 'a')
+        b = styler('class:b', 'b')
+        self.assertEqual(styler.style_id('class:a'), a.style_id)
+        self.assertNotEqual(a.style_id, b.style_id)
+        self.assertEqual(styler.styles[b.style_id], 'class:b')
+
+    def test_overwrite(self):
+        styler = Styler()
+        parser = styler('class:outer', styler('class:inner', ppc.integer))
+        parser.parseString('123', parseAll=True)
+        self.assertEqual(styler.fragments, {0: ('class:outer', '123')})
+        styler.delete(0)
+        self.assertEqual(styler.locs(), [])
+
 
 class TestDummyStyler(unittest.TestCase):
     def test_false(self):
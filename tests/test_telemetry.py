@@ -0,0 +1,88 @@
+"""Unit tests for telemetry."""
+
+# pylint: disable=missing-docstring
+
+import threading
+import unittest
+
+from prompt_toolkit.document import Document
+import pyparsing as pp
+from pyparsing import pyparsing_common as ppc
+
+from pp_highlighting import PPHighlighter, PPValidator
+from pp_highlighting.telemetry import Aggregator, CallStats
+
+
+def parser_factory(styler):
+    LPAR, RPAR = map(pp.Suppress, '()')
+    c = pp.Forward()
+    c <<= styler('class:int', ppc.integer) | LPAR + pp.ZeroOrMore(c) + RPAR
+    return c
+
+
+def stats(time, operation='highlight', length=10, cache_hit=None):
+    return CallStats(operation, length, None, None, time, cache_hit)
+
+
+class TestAggregator(unittest.TestCase):
+    def test_percentiles(self):
+        aggregator = Aggregator()
+        for i in range(11):
+            aggregator(stats(i / 10))
+        self.assertEqual(aggregator.percentiles('highlight'), {50: 0.5, 90: 0.9, 99: 0.99})
+        self.assertEqual(aggregator.percentiles('highlight', 'length', [0, 100]),
+                         {0: 10, 100: 10})
+        self.assertEqual(aggregator.percentiles('highlight', 'fragments'), {})
+        self.assertEqual(aggregator.percentiles('validate'), {})
+
+    def test_window(self):
+        aggregator = Aggregator(window=2)
+        for i in range(5):
+            aggregator(stats(i))
+        self.assertEqual(aggregator.percentiles('highlight', percents=[0, 100]),
+                         {0: 3, 100: 4})
+        self.assertEqual(aggregator.summary('highlight')['count'], 5)
+
+    def test_summary(self):
+        aggregator = Aggregator()
+        aggregator(stats(1, cache_hit=False))
+        aggregator(stats(2, cache_hit=True))
+        aggregator(stats(3, cache_hit=True))
+        aggregator(stats(4))
+        aggregator(stats(1, 'validate'))
+        self.assertEqual(aggregator.operations(), ['highlight', 'validate'])
+        summary = aggregator.summary('highlight')
+        self.assertEqual(summary['count'], 4)
+        self.assertEqual(summary['total_time'], 10)
+        self.assertEqual(summary['throughput'], 4)
+        self.assertAlmostEqual(summary['cache_hit_rate'], 2 / 3)
+        self.assertEqual(summary['p50'], 2.5)
+        self.assertIsNone(aggregator.summary('validate')['cache_hit_rate'])
+        aggregator.clear()
+        self.assertEqual(aggregator.operations(), [])
+        with self.assertRaises(KeyError):
+            aggregator.summary('highlight')
+
+    def test_observer(self):
+        aggregator = Aggregator()
+        pph = PPHighlighter(parser_factory, observer=aggregator)
+        ppv = PPValidator(pph, observer=aggregator)
+
+        def work():
+            for _ in range(50):
+                pph.highlight('(1 (a 2))')
+                ppv.validate(Document('(1 2)'))
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(aggregator.summary('highlight')['count'], 200)
+        self.assertEqual(aggregator.summary('validate')['count'], 200)
+        self.assertEqual(aggregator.percentiles('highlight', 'failures', [0, 100]),
+                         {0: 2, 100: 2})
+
+
+if __name__ == '__main__':
+    unittest.main()